@@ -3,6 +3,8 @@ import bcrypt
 from motor.motor_asyncio import AsyncIOMotorClient
 import asyncio
 
+from passwords import BCRYPT_ROUNDS
+
 MONGO_URL = os.getenv("MONGO_URL")
 NAME_DB = os.getenv("NAME_DB")
 
@@ -15,7 +17,7 @@ async def create_admin():
         print("✅ Admin ya existe")
         return
 
-    hashed = bcrypt.hashpw("admin123".encode(), bcrypt.gensalt())
+    hashed = bcrypt.hashpw("admin123".encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
     await db.users.insert_one({
         "username": "admin",
         "password": hashed,
@@ -1,14 +1,24 @@
 from datetime import datetime, timedelta, timezone
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Query, status
 from fastapi.security import OAuth2PasswordBearer
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
+from typing import List, Optional
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
 from bson import ObjectId
-import bcrypt
+import asyncio
+import base64
+import re
+import logging
 import jwt
 import os
 
+from passwords import hasher
+from signing import JWKS_MAX_AGE, JWT_ALGORITHM, KeySet
+from user_cache import user_cache
+
 # --- CONFIG ---
 app = FastAPI()
 
@@ -18,19 +28,44 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 MONGO_URL = os.getenv("MONGO_URL")
 SECRET_KEY = os.getenv("SECRET_KEY")
 NAME_DB = os.getenv("NAME_DB")
-ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "120"))  # NUEVO
+MAX_INTROSPECT_TOKENS = int(os.getenv("MAX_INTROSPECT_TOKENS", "500"))
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", "100"))
+MAX_USERS_PAGE_SIZE = int(os.getenv("MAX_USERS_PAGE_SIZE", "1000"))
 
 
 client = AsyncIOMotorClient(MONGO_URL)
 db = client[NAME_DB]
 
+keyset = KeySet(JWT_ALGORITHM, SECRET_KEY)
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
+logger = logging.getLogger("uvicorn.error")
+
+# Rehash de contraseñas tras un login (no bloquea la respuesta)
+rehash_tasks = set()
+
+
+@app.on_event("startup")
+async def ensure_indexes():
+    try:
+        await db.users.create_index("username", unique=True, name="uniq_username")
+    except Exception as e:
+        # Si ya hay usernames repetidos el índice no se crea y create_user deja de
+        # detectar duplicados: hay que depurarlos a mano y reiniciar
+        logger.error(f"❌ No se pudo crear el índice único de users.username: {e}")
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await asyncio.gather(*rehash_tasks, return_exceptions=True)
+    hasher.shutdown()
 
 
 # --- MODELOS ---
@@ -43,6 +78,9 @@ class UserLogin(BaseModel):
     username: str
     password: str
 
+class TokenIntrospection(BaseModel):
+    tokens: List[str]
+
 # --- HELPERS ---
 def serialize_user(user):
     return {
@@ -51,23 +89,57 @@ def serialize_user(user):
         "roles": [user["role"]],
     }
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
-    try:
-        # Si el token trae `exp`, PyJWT validará expiración automáticamente
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"require": ["exp", "iat"]})
-        user_id = payload.get("id")
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Token inválido")
+# Cursor de /auth/users: último username de la página en base64 (un username
+# puede tener caracteres que no van en un header)
+def username_cursor(username: str) -> str:
+    return base64.urlsafe_b64encode(username.encode()).decode()
 
-        user = await db.users.find_one({"_id": ObjectId(user_id)})
-        if not user:
-            raise HTTPException(status_code=401, detail="Usuario no encontrado")
+def username_from_cursor(cursor: str) -> str:
+    try:
+        return base64.b64decode(cursor.encode(), altchars=b"-_", validate=True).decode()
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=422, detail="Cursor de usuarios inválido")
 
-        return user
+def decode_token(token: str) -> dict:
+    try:
+        # Si el token trae `exp`, PyJWT validará expiración automáticamente
+        payload = keyset.decode(token, options={"require": ["exp", "iat"]})
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expirado")
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Token inválido")
+    if not payload.get("id") or not ObjectId.is_valid(payload["id"]):
+        raise HTTPException(status_code=401, detail="Token inválido")
+    return payload
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    user_id = decode_token(token)["id"]
+
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await db.users.find_one({"_id": ObjectId(user_id)}, {"password": 0})
+        if not user:
+            raise HTTPException(status_code=401, detail="Usuario no encontrado")
+        user_cache.put(user_id, user)
+
+    return user
+
+async def find_users_by_ids(user_ids) -> dict:
+    """Usuarios por id: primero el cache, el resto en una sola consulta $in."""
+    users = {}
+    missing = []
+    for user_id in dict.fromkeys(user_ids):
+        user = user_cache.get(user_id)
+        if user is None:
+            missing.append(ObjectId(user_id))
+        else:
+            users[user_id] = user
+    if missing:
+        async for user in db.users.find({"_id": {"$in": missing}}, {"password": 0}):
+            user_id = str(user["_id"])
+            user_cache.put(user_id, user)
+            users[user_id] = user
+    return users
 
 def create_access_token(*, user_id: str, role: str) -> str:
     now = datetime.now(timezone.utc)
@@ -79,7 +151,16 @@ def create_access_token(*, user_id: str, role: str) -> str:
         "exp": int(expire.timestamp()),
         "iss": "auth-service"  # cambia si quieres
     }
-    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+    return keyset.sign(payload)
+
+async def rehash_password(user_id, old_hash: bytes, password: str):
+    """Actualiza un hash con otro work factor; solo si nadie cambió la contraseña entretanto."""
+    try:
+        new_hash = await hasher.hash(password)
+        result = await db.users.update_one({"_id": user_id, "password": old_hash}, {"$set": {"password": new_hash}})
+        hasher.rehashed += result.modified_count
+    except Exception as e:
+        logger.error(f"❌ No se pudo actualizar el hash de la contraseña: {e}")
 
 
 # --- ENDPOINTS ---
@@ -90,9 +171,14 @@ async def login(user: UserLogin):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
 
     # Asegúrate de que db_user["password"] sea bytes en la colección
-    if not bcrypt.checkpw(user.password.encode(), db_user["password"]):
+    if not await hasher.verify(user.password, db_user["password"]):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
 
+    if hasher.needs_rehash(db_user["password"]):
+        task = asyncio.create_task(rehash_password(db_user["_id"], db_user["password"], user.password))
+        rehash_tasks.add(task)
+        task.add_done_callback(rehash_tasks.discard)
+
     token = create_access_token(user_id=str(db_user["_id"]), role=db_user["role"])  # CAMBIO
 
     # (Opcional pero útil para el frontend: segundos hasta expirar)
@@ -108,15 +194,17 @@ async def create_user(new_user: UserCreate, current_user: dict = Depends(get_cur
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Solo los administradores pueden crear usuarios")
 
-    if await db.users.find_one({"username": new_user.username}):
+    hashed = await hasher.hash(new_user.password)
+    try:
+        # Sin find_one previo: si dos admins crean el mismo username a la vez, uniq_username deja pasar solo uno
+        result = await db.users.insert_one({
+            "username": new_user.username,
+            "password": hashed,
+            "role": new_user.role
+        })
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Usuario ya existe")
-
-    hashed = bcrypt.hashpw(new_user.password.encode(), bcrypt.gensalt())
-    result = await db.users.insert_one({
-        "username": new_user.username,
-        "password": hashed,
-        "role": new_user.role
-    })
+    user_cache.invalidate(str(result.inserted_id))
 
     return {
         "id": str(result.inserted_id),
@@ -125,19 +213,93 @@ async def create_user(new_user: UserCreate, current_user: dict = Depends(get_cur
     }
 
 @app.get("/auth/users")
-async def list_users(current_user: dict = Depends(get_current_user)):
+async def list_users(
+    limit: int = Query(USERS_PAGE_SIZE, ge=1),
+    cursor: Optional[str] = Query(None, description="Valor de X-Next-Cursor para pedir la página siguiente"),
+    q: Optional[str] = Query(None, min_length=1, description="Prefijo de username"),
+    current_user: dict = Depends(get_current_user),
+):
+    """
+    Usuarios ordenados por username, de a `limit`. La respuesta sigue siendo
+    la lista de siempre; si quedan más, X-Next-Cursor trae el cursor de la
+    siguiente. Continúa desde el último username (no con skip), así un alta
+    durante la paginación no hace saltar ni repetir usuarios.
+    """
     if current_user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="Solo los administradores pueden ver la lista de usuarios")
 
+    limit = min(limit, MAX_USERS_PAGE_SIZE)
+    username_filter = {}
+    if q:
+        # Solo prefijo y distinguiendo mayúsculas: Mongo recorre únicamente ese tramo de uniq_username
+        username_filter["$regex"] = "^" + re.escape(q)
+    if cursor:
+        username_filter["$gt"] = username_from_cursor(cursor)
+    query = {"username": username_filter} if username_filter else {}
+
     usuarios = []
-    async for u in db.users.find({}, {"password": 0}):
+    async for u in db.users.find(query, {"password": 0}).sort("username", 1).limit(limit + 1):
         usuarios.append({
             "id": str(u["_id"]),
             "username": u["username"],
             "role": u["role"]
         })
 
-    return usuarios
+    headers = {}
+    if len(usuarios) > limit:
+        usuarios = usuarios[:limit]
+        headers["X-Next-Cursor"] = username_cursor(usuarios[-1]["username"])
+    return JSONResponse(usuarios, headers=headers)
+
+
+@app.post("/auth/introspect")
+async def introspect_tokens(body: TokenIntrospection):
+    """
+    Valida varios tokens en una llamada (para gateways/servicios).
+    Resultado por token, en el orden recibido; un token inválido no falla el lote.
+    El rol es el actual del usuario, no el que traía el token.
+    """
+    if len(body.tokens) > MAX_INTROSPECT_TOKENS:
+        raise HTTPException(status_code=422, detail=f"Máximo {MAX_INTROSPECT_TOKENS} tokens por consulta")
+
+    payloads = {}
+    for token in dict.fromkeys(body.tokens):
+        try:
+            payloads[token] = decode_token(token)
+        except HTTPException as e:
+            payloads[token] = e.detail
+
+    users = await find_users_by_ids(p["id"] for p in payloads.values() if isinstance(p, dict))
+
+    results = []
+    for token in body.tokens:
+        payload = payloads[token]
+        if not isinstance(payload, dict):
+            results.append({"active": False, "error": payload})
+            continue
+        user = users.get(payload["id"])
+        if user is None:
+            results.append({"active": False, "user_id": payload["id"], "error": "Usuario no encontrado"})
+            continue
+        results.append({
+            "active": True,
+            "user_id": payload["id"],
+            "username": user["username"],
+            "role": user["role"],
+            "exp": payload["exp"],
+        })
+    return {"results": results}
+
+
+@app.get("/auth/.well-known/jwks.json")
+async def jwks():
+    """Claves públicas para que otros servicios verifiquen los tokens localmente."""
+    return JSONResponse(keyset.jwks(), headers={"Cache-Control": f"public, max-age={JWKS_MAX_AGE}"})
+
+
+@app.get("/auth/metrics")
+async def metrics():
+    return {"hashing": hasher.stats(), "user_cache": user_cache.stats()}
 
 
 @app.get("/auth/me")
@@ -0,0 +1,119 @@
+import os
+import time
+import asyncio
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+import bcrypt
+from fastapi import HTTPException
+
+# --- CONFIG ---
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))  # work factor para hashes nuevos
+HASH_POOL = os.getenv("HASH_POOL", "thread")  # thread (bcrypt suelta el GIL) | process
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 2)))
+# Operaciones en curso + en espera; por encima se responde 503 en vez de encolar sin límite
+HASH_MAX_PENDING = int(os.getenv("HASH_MAX_PENDING", str(HASH_WORKERS * 8)))
+HASH_LATENCY_SAMPLES = int(os.getenv("HASH_LATENCY_SAMPLES", "1000"))
+
+
+# Funciones de módulo para que el pool de procesos pueda serializarlas
+def _hashpw(password: bytes, rounds: int) -> tuple[bytes, float]:
+    start = time.perf_counter()
+    hashed = bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds))
+    return hashed, time.perf_counter() - start
+
+
+def _checkpw(password: bytes, hashed: bytes) -> tuple[bool, float]:
+    start = time.perf_counter()
+    ok = bcrypt.checkpw(password, hashed)
+    return ok, time.perf_counter() - start
+
+
+def _percentile(samples, q: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+
+class PasswordHasher:
+    """
+    bcrypt fuera del event loop: las operaciones corren en un pool acotado y,
+    si hay más de HASH_MAX_PENDING en curso, se rechazan con 503 (Retry-After)
+    para que un pico de logins no deje sin respuesta a /auth/me.
+    """
+
+    def __init__(self):
+        self._executor: Optional[Executor] = None
+        self.pending = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self.counts = {"hash": 0, "verify": 0}
+        self._wait = deque(maxlen=HASH_LATENCY_SAMPLES)     # s en cola
+        self._compute = deque(maxlen=HASH_LATENCY_SAMPLES)  # s de bcrypt
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if HASH_POOL == "process":
+                self._executor = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def _run(self, op: str, fn, *args):
+        if self.pending >= HASH_MAX_PENDING:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Servicio de autenticación saturado, reintenta en un momento",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            result, compute = await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self.pending -= 1
+        self.counts[op] += 1
+        self._compute.append(compute)
+        self._wait.append(max(0.0, time.perf_counter() - start - compute))
+        return result
+
+    async def hash(self, password: str) -> bytes:
+        return await self._run("hash", _hashpw, password.encode(), BCRYPT_ROUNDS)
+
+    async def verify(self, password: str, hashed: bytes) -> bool:
+        return await self._run("verify", _checkpw, password.encode(), hashed)
+
+    @staticmethod
+    def needs_rehash(hashed: bytes) -> bool:
+        """True si el hash se generó con otro work factor ($2b$<cost>$...)."""
+        try:
+            return int(hashed.split(b"$")[2]) != BCRYPT_ROUNDS
+        except (IndexError, ValueError):
+            return False
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "rounds": BCRYPT_ROUNDS,
+            "pool": HASH_POOL,
+            "workers": HASH_WORKERS,
+            "pending": self.pending,
+            "max_pending": HASH_MAX_PENDING,
+            "rejected": self.rejected,
+            "rehashed": self.rehashed,
+            **self.counts,
+            "compute_ms_p50": _percentile(self._compute, 0.5),
+            "compute_ms_p95": _percentile(self._compute, 0.95),
+            "wait_ms_p50": _percentile(self._wait, 0.5),
+            "wait_ms_p95": _percentile(self._wait, 0.95),
+        }
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,96 @@
+import os
+import json
+import glob
+import logging
+from typing import Optional
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+from jwt.algorithms import OKPAlgorithm, RSAAlgorithm
+
+logger = logging.getLogger("uvicorn.error")
+
+# --- CONFIG ---
+# HS256 (SECRET_KEY compartida) | RS256 | EdDSA (Ed25519)
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+# Claves privadas PEM, una por archivo: <kid>.pem. Todas se publican en el JWKS;
+# se firma con JWT_ACTIVE_KID (o la última por nombre). Para rotar: agregar la
+# nueva, activarla, y borrar la vieja cuando venzan sus tokens.
+JWT_KEYS_DIR = os.getenv("JWT_KEYS_DIR", "/run/secrets/jwt")
+JWT_ACTIVE_KID = os.getenv("JWT_ACTIVE_KID")
+JWKS_MAX_AGE = int(os.getenv("JWKS_MAX_AGE", "300"))  # s, Cache-Control del JWKS
+
+ASYMMETRIC_ALGORITHMS = ("RS256", "EdDSA")
+
+
+class KeySet:
+    """
+    Claves de firma de auth-service. Con HS256 se comporta como antes
+    (SECRET_KEY); con RS256/EdDSA firma con la clave activa (header kid) y
+    verifica con cualquiera de las publicadas. Los tokens HS256 emitidos antes
+    del cambio se siguen aceptando mientras SECRET_KEY esté configurada.
+    """
+
+    def __init__(self, algorithm: str, secret: Optional[str]):
+        if algorithm not in ("HS256",) + ASYMMETRIC_ALGORITHMS:
+            raise ValueError(f"JWT_ALGORITHM no soportado: {algorithm}")
+        self.algorithm = algorithm
+        self.secret = secret
+        self.private_keys: dict = {}
+        self.active_kid: Optional[str] = None
+        if algorithm in ASYMMETRIC_ALGORITHMS:
+            self._load_keys()
+
+    def _load_keys(self):
+        expected = rsa.RSAPrivateKey if self.algorithm == "RS256" else ed25519.Ed25519PrivateKey
+        for path in sorted(glob.glob(os.path.join(JWT_KEYS_DIR, "*.pem"))):
+            kid = os.path.splitext(os.path.basename(path))[0]
+            with open(path, "rb") as f:
+                key = serialization.load_pem_private_key(f.read(), password=None)
+            if not isinstance(key, expected):
+                logger.error(f"❌ Clave {kid} no corresponde a {self.algorithm}, se ignora")
+                continue
+            self.private_keys[kid] = key
+
+        if not self.private_keys:
+            # Solo para desarrollo: los tokens no sobreviven a un reinicio ni se comparten entre réplicas
+            logger.warning(f"⚠️ Sin claves en {JWT_KEYS_DIR}: se genera una clave {self.algorithm} efímera")
+            key = rsa.generate_private_key(public_exponent=65537, key_size=2048) \
+                if self.algorithm == "RS256" else ed25519.Ed25519PrivateKey.generate()
+            self.private_keys["ephemeral"] = key
+
+        self.active_kid = JWT_ACTIVE_KID if JWT_ACTIVE_KID in self.private_keys else list(self.private_keys)[-1]
+        logger.info(f"🔑 Firma {self.algorithm} con kid={self.active_kid} ({len(self.private_keys)} clave(s) publicadas)")
+
+    def sign(self, payload: dict) -> str:
+        if self.algorithm == "HS256":
+            return jwt.encode(payload, self.secret, algorithm="HS256")
+        return jwt.encode(
+            payload, self.private_keys[self.active_kid], algorithm=self.algorithm,
+            headers={"kid": self.active_kid},
+        )
+
+    def decode(self, token: str, **kwargs) -> dict:
+        """Como jwt.decode; lanza jwt.PyJWTError si la firma/kid no es válida."""
+        header = jwt.get_unverified_header(token)
+        alg = header.get("alg")
+        if alg == "HS256" and self.secret:
+            return jwt.decode(token, self.secret, algorithms=["HS256"], **kwargs)
+        if alg != self.algorithm or alg not in ASYMMETRIC_ALGORITHMS:
+            raise jwt.InvalidAlgorithmError("Algoritmo no permitido")
+        key = self.private_keys.get(header.get("kid"))
+        if key is None:
+            raise jwt.InvalidKeyError("kid desconocido")
+        return jwt.decode(token, key.public_key(), algorithms=[alg], **kwargs)
+
+    def jwks(self) -> dict:
+        """Claves públicas en formato JWKS (vacío con HS256: no hay nada que publicar)."""
+        keys = []
+        for kid, key in self.private_keys.items():
+            if self.algorithm == "RS256":
+                jwk = json.loads(RSAAlgorithm.to_jwk(key.public_key()))
+            else:
+                jwk = json.loads(OKPAlgorithm.to_jwk(key.public_key()))
+            keys.append({**jwk, "kid": kid, "alg": self.algorithm, "use": "sig"})
+        return {"keys": keys}
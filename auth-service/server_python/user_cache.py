@@ -0,0 +1,63 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))  # s (acota lo desactualizado entre réplicas)
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "10000"))
+
+
+class UserCache:
+    """
+    Usuarios (sin hash de contraseña) por id, con TTL y tope LRU.
+    Cualquier escritura sobre un usuario debe llamar a invalidate().
+    """
+
+    def __init__(self, ttl: float = USER_CACHE_TTL, max_size: int = USER_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, tuple[dict, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id: str) -> Optional[dict]:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, user_id: str, user: dict):
+        if self.ttl <= 0:
+            return
+        self._entries[user_id] = (user, time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: Optional[str] = None):
+        """Sin id vacía todo (p.ej. cambios masivos)."""
+        self.invalidations += 1
+        if user_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+            "invalidations": self.invalidations,
+            "ttl": self.ttl,
+        }
+
+
+user_cache = UserCache()
@@ -18,3 +18,41 @@ CREATE TABLE IF NOT EXISTS invoice_items (
 
 -- índices útiles
 CREATE INDEX IF NOT EXISTS idx_invoice_items_invoice_id ON invoice_items(invoice_id);
+-- paginación por llave (created_at, id) y filtros por rango de fechas
+CREATE INDEX IF NOT EXISTS idx_invoices_created_at_id ON invoices(created_at, id);
+
+-- acumulado diario para reportes (se actualiza en la misma transacción que la factura)
+CREATE TABLE IF NOT EXISTS sales_daily (
+  day DATE PRIMARY KEY,
+  total NUMERIC(14,2) NOT NULL DEFAULT 0,
+  invoice_count INTEGER NOT NULL DEFAULT 0
+);
+
+-- respuestas guardadas por Idempotency-Key (POST /billing/facturas)
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+  key TEXT PRIMARY KEY,
+  request_hash TEXT NOT NULL,
+  status TEXT NOT NULL,
+  response JSONB,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  expires_at TIMESTAMPTZ NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys(expires_at);
+
+-- reservas facturadas cuyo commit en inventory falta confirmar (se reintentan en segundo plano)
+CREATE TABLE IF NOT EXISTS pending_commits (
+  reservation_id TEXT PRIMARY KEY,
+  status TEXT NOT NULL DEFAULT 'pending',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  last_error TEXT,
+  next_attempt_at TIMESTAMPTZ NOT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_pending_commits_next_attempt ON pending_commits(status, next_attempt_at);
+
+-- reservas pedidas a inventory que aún no tienen factura (las huérfanas se liberan en segundo plano)
+CREATE TABLE IF NOT EXISTS pending_reservations (
+  reservation_id TEXT PRIMARY KEY,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_pending_reservations_created_at ON pending_reservations(created_at);
@@ -1,12 +1,21 @@
+import io
 import os
+import csv
+import json
+import time
+import base64
+import hashlib
 import uuid
+import asyncio
 import decimal
 import logging
-from typing import List, Optional
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Iterable, List, Literal, Optional
 
 import asyncpg
 import httpx
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field, ConfigDict
 from datetime import datetime, date, timedelta, timezone
 
@@ -22,35 +31,403 @@ POSTGRES_PWD  = os.getenv("POSTGRES_PASSWORD", "billing")
 INVENTORY_BASE_URL = os.getenv("INVENTORY_BASE_URL", "http://inventory-service:8001/inventory")
 PRINT_BASE_URL = os.getenv("PRINT_BASE_URL", "http://print-service:4004")
 COMMIT_AFTER_CREATE = os.getenv("COMMIT_AFTER_CREATE", "true").lower() == "true"
+# Commit de reservas: reintentos en la petición y luego en segundo plano desde pending_commits
+COMMIT_RETRIES = int(os.getenv("COMMIT_RETRIES", "3"))
+COMMIT_RETRY_INTERVAL = float(os.getenv("COMMIT_RETRY_INTERVAL", "30"))  # s
+COMMIT_RETRY_MAX_DELAY = float(os.getenv("COMMIT_RETRY_MAX_DELAY", "300"))  # s
+# Reservas en pending_reservations sin factura pasado este tiempo se liberan en inventory (huérfanas)
+RESERVATION_ORPHAN_AFTER = float(os.getenv("RESERVATION_ORPHAN_AFTER", "300"))  # s
+RESERVATION_ORPHAN_INTERVAL = float(os.getenv("RESERVATION_ORPHAN_INTERVAL", "60"))  # s
+# true: encola la impresión y devuelve print_job_id sin esperar el PDF
+PRINT_ASYNC = os.getenv("PRINT_ASYNC", "true").lower() == "true"
+
+# Clientes HTTP salientes (uno por upstream, con keep-alive)
+INVENTORY_TIMEOUT = float(os.getenv("INVENTORY_TIMEOUT", "15"))
+INVENTORY_MAX_CONNECTIONS = int(os.getenv("INVENTORY_MAX_CONNECTIONS", "50"))
+INVENTORY_MAX_KEEPALIVE = int(os.getenv("INVENTORY_MAX_KEEPALIVE", "20"))
+PRINT_TIMEOUT = float(os.getenv("PRINT_TIMEOUT", "10"))
+PRINT_MAX_CONNECTIONS = int(os.getenv("PRINT_MAX_CONNECTIONS", "20"))
+PRINT_MAX_KEEPALIVE = int(os.getenv("PRINT_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+# Máximo de product_ids por POST /products/lookup (misma variable que lee inventory-service)
+MAX_LOOKUP_IDS = int(os.getenv("MAX_LOOKUP_IDS", "1000"))
+
+# Idempotency-Key en POST /billing/facturas
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))  # s que se guarda la respuesta
+IDEMPOTENCY_WAIT = float(os.getenv("IDEMPOTENCY_WAIT", "30"))  # s que se espera a otra réplica
+# s que una key 'in_progress' queda tomada; si el proceso muere, otro reintento la retoma pasado este plazo
+IDEMPOTENCY_LEASE = float(os.getenv("IDEMPOTENCY_LEASE", "60"))
+IDEMPOTENCY_PURGE_INTERVAL = float(os.getenv("IDEMPOTENCY_PURGE_INTERVAL", "600"))  # s
+
+# Cache LRU de detalle de facturas (son inmutables)
+INVOICE_CACHE_MAX_SIZE = int(os.getenv("INVOICE_CACHE_MAX_SIZE", "2000"))
+
+# Creación de facturas en lote
+BATCH_MAX_INVOICES = int(os.getenv("BATCH_MAX_INVOICES", "500"))
+
+# Exportación en streaming
+EXPORT_PREFETCH = int(os.getenv("EXPORT_PREFETCH", "1000"))  # filas por viaje al servidor
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "500"))  # filas por chunk HTTP
+# Cada exportación usa su propia conexión (fuera del pool): se limita cuántas a la vez
+EXPORT_MAX_CONCURRENT = int(os.getenv("EXPORT_MAX_CONCURRENT", "2"))
+EXPORT_MAX_DAYS = int(os.getenv("EXPORT_MAX_DAYS", "366"))
+
+# Cache de precios en proceso
+PRICE_CACHE_TTL = float(os.getenv("PRICE_CACHE_TTL", "60"))  # s
+PRICE_CACHE_MAX_SIZE = int(os.getenv("PRICE_CACHE_MAX_SIZE", "10000"))
 
 logger = logging.getLogger("uvicorn.error")
 
+# ------------------------------
+# Clientes HTTP upstream
+# ------------------------------
+class UpstreamClient:
+    """
+    Envuelve un httpx.AsyncClient de larga vida para un upstream.
+    Cuenta peticiones en vuelo y si cada una reutilizó una conexión del pool
+    (hit) o tuvo que abrir una nueva (miss).
+    """
+
+    def __init__(self, name: str, timeout: float, max_connections: int, max_keepalive: int):
+        self.name = name
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.client: httpx.AsyncClient | None = None
+        self.requests = 0
+        self.in_flight = 0
+        self.pool_hits = 0
+        self.pool_misses = 0
+        self.errors = 0
+
+    def start(self):
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(self.timeout),
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+
+    async def close(self):
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        if self.client is None:
+            raise RuntimeError(f"Cliente HTTP '{self.name}' no inicializado")
+
+        opened_connection = False
+
+        async def trace(event_name: str, info: dict):
+            # httpcore emite este evento solo cuando abre un socket nuevo
+            nonlocal opened_connection
+            if event_name == "connection.connect_tcp.started":
+                opened_connection = True
+
+        self.requests += 1
+        self.in_flight += 1
+        try:
+            r = await self.client.request(method, url, extensions={"trace": trace}, **kwargs)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+        if opened_connection:
+            self.pool_misses += 1
+        else:
+            self.pool_hits += 1
+        return r
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "pool_hits": self.pool_hits,
+            "pool_misses": self.pool_misses,
+            "errors": self.errors,
+            "max_connections": self.max_connections,
+            "max_keepalive": self.max_keepalive,
+            "timeout": self.timeout,
+        }
+
+# ------------------------------
+# Cache de precios
+# ------------------------------
+class PriceCache:
+    """
+    Cache LRU con TTL de precios por product_id.
+    Los misses concurrentes de un mismo producto comparten una sola carga
+    (single-flight): la primera petición la lanza y el resto la espera.
+    """
+
+    def __init__(self, loader: Callable[[List[str]], Awaitable[dict[str, float]]], ttl: float, max_size: int):
+        self._loader = loader
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[str, tuple[float, float]] = OrderedDict()  # pid -> (precio, expira)
+        self._pending: dict[str, asyncio.Task] = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    async def get_many(self, product_ids: Iterable[str]) -> dict[str, float]:
+        """Devuelve {product_id: precio} solo para los ids pedidos que existan."""
+        wanted = list(dict.fromkeys(product_ids))
+        now = time.monotonic()
+        prices: dict[str, float] = {}
+        waiting: set[asyncio.Task] = set()
+        to_load: List[str] = []
+
+        for pid in wanted:
+            entry = self._entries.get(pid)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(pid)
+                prices[pid] = entry[0]
+                self.hits += 1
+                continue
+            self.misses += 1
+            task = self._pending.get(pid)
+            if task:
+                waiting.add(task)
+            else:
+                to_load.append(pid)
+
+        if to_load:
+            task = asyncio.create_task(self._load(to_load))
+            for pid in to_load:
+                self._pending[pid] = task
+            waiting.add(task)
+
+        for task in waiting:
+            loaded = await task
+            for pid in wanted:
+                if pid not in prices and pid in loaded:
+                    prices[pid] = loaded[pid]
+        return prices
+
+    async def _load(self, product_ids: List[str]) -> dict[str, float]:
+        generation = self._generation
+        try:
+            loaded = await self._loader(product_ids)
+            self.loads += 1
+            # Si hubo una invalidación durante la carga, no guardamos datos viejos
+            if generation == self._generation:
+                expires = time.monotonic() + self.ttl
+                for pid, price in loaded.items():
+                    self._store(pid, price, expires)
+            return loaded
+        finally:
+            me = asyncio.current_task()
+            for pid in product_ids:
+                if self._pending.get(pid) is me:
+                    del self._pending[pid]
+
+    def _store(self, product_id: str, price: float, expires: float):
+        self._entries[product_id] = (price, expires)
+        self._entries.move_to_end(product_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, product_ids: Optional[Iterable[str]] = None) -> int:
+        """Invalida los ids dados (o todo el cache). Devuelve cuántas entradas se quitaron."""
+        self._generation += 1
+        if product_ids is None:
+            removed = len(self._entries)
+            self._entries.clear()
+            return removed
+        removed = 0
+        for pid in product_ids:
+            if self._entries.pop(pid, None) is not None:
+                removed += 1
+        return removed
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "pending": len(self._pending),
+        }
+
+# ------------------------------
+# Cache LRU
+# ------------------------------
+class LRUCache:
+    """LRU acotado sin expiración, para datos que no cambian (p.ej. facturas)."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+inventory_http = UpstreamClient("inventory", INVENTORY_TIMEOUT, INVENTORY_MAX_CONNECTIONS, INVENTORY_MAX_KEEPALIVE)
+print_http = UpstreamClient("print", PRINT_TIMEOUT, PRINT_MAX_CONNECTIONS, PRINT_MAX_KEEPALIVE)
+UPSTREAMS = (inventory_http, print_http)
+
 # ------------------------------
 # App & DB pool
 # ------------------------------
 app = FastAPI(title="Billing Service")
 pool: asyncpg.Pool | None = None
+background_tasks: List[asyncio.Task] = []
 
-@app.on_event("startup")
-async def startup():
-    global pool
-    pool = await asyncpg.create_pool(
+# DDL idempotente para bases ya inicializadas (db/init solo corre en una base nueva)
+SCHEMA_MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS sales_daily (
+      day DATE PRIMARY KEY,
+      total NUMERIC(14,2) NOT NULL DEFAULT 0,
+      invoice_count INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+      key TEXT PRIMARY KEY,
+      request_hash TEXT NOT NULL,
+      status TEXT NOT NULL,
+      response JSONB,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+      expires_at TIMESTAMPTZ NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys(expires_at)",
+    """
+    CREATE TABLE IF NOT EXISTS pending_commits (
+      reservation_id TEXT PRIMARY KEY,
+      status TEXT NOT NULL DEFAULT 'pending',
+      attempts INTEGER NOT NULL DEFAULT 0,
+      last_error TEXT,
+      next_attempt_at TIMESTAMPTZ NOT NULL,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_pending_commits_next_attempt ON pending_commits(status, next_attempt_at)",
+    """
+    CREATE TABLE IF NOT EXISTS pending_reservations (
+      reservation_id TEXT PRIMARY KEY,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_pending_reservations_created_at ON pending_reservations(created_at)",
+]
+
+# Índices sobre tablas grandes: CONCURRENTLY no bloquea escrituras pero no puede ir en
+# una transacción, así que se crean aparte (ver ensure_concurrent_indexes)
+CONCURRENT_INDEXES = {
+    "idx_invoices_created_at_id": "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_invoices_created_at_id ON invoices(created_at, id)",
+}
+
+def _pg_params() -> dict:
+    return dict(
         user=POSTGRES_USER,
         password=POSTGRES_PWD,
         database=POSTGRES_DB,
         host=POSTGRES_HOST,
         port=POSTGRES_PORT,
-        min_size=1,
-        max_size=5,
     )
+
+async def ensure_schema():
+    assert pool is not None
+    async with pool.acquire() as conn:
+        for ddl in SCHEMA_MIGRATIONS:
+            await conn.execute(ddl)
+
+async def ensure_concurrent_indexes():
+    """
+    En segundo plano y con conexión propia (el build puede tardar minutos).
+    Un CONCURRENTLY interrumpido deja el índice inválido: se borra y se vuelve
+    a crear. El advisory lock evita que dos réplicas lo hagan a la vez.
+    """
+    conn = None
+    try:
+        conn = await asyncpg.connect(**_pg_params())
+        await conn.execute("SELECT pg_advisory_lock(hashtext('billing_concurrent_indexes'))")
+        for name, ddl in CONCURRENT_INDEXES.items():
+            invalid = await conn.fetchval(
+                """
+                SELECT NOT i.indisvalid FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = $1
+                """,
+                name
+            )
+            if invalid:
+                logger.warning("Índice %s inválido (build interrumpido), se vuelve a crear", name)
+                await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            await conn.execute(ddl)
+    except Exception as e:
+        logger.error("❌ No se pudieron crear los índices: %s", e)
+    finally:
+        if conn is not None:
+            await conn.close()
+
+@app.on_event("startup")
+async def startup():
+    global pool
+    pool = await asyncpg.create_pool(**_pg_params(), min_size=1, max_size=5)
     logger.info("✅ Pool PostgreSQL listo")
+    await ensure_schema()
+    background_tasks.append(asyncio.create_task(ensure_concurrent_indexes()))
+    for upstream in UPSTREAMS:
+        upstream.start()
+    logger.info("✅ Clientes HTTP upstream listos")
+    background_tasks.append(asyncio.create_task(purge_idempotency_keys_loop()))
+    background_tasks.append(asyncio.create_task(release_orphan_reservations_loop()))
+    if COMMIT_AFTER_CREATE:
+        background_tasks.append(asyncio.create_task(retry_pending_commits_loop()))
 
 @app.on_event("shutdown")
 async def shutdown():
     global pool
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
     if pool:
         await pool.close()
         logger.info("🔌 Pool PostgreSQL cerrado")
+    for upstream in UPSTREAMS:
+        await upstream.close()
+    logger.info("🔌 Clientes HTTP upstream cerrados")
 
 # ------------------------------
 # Modelos
@@ -79,6 +456,30 @@ class InvoiceOut(BaseModel):
     pdf_url: Optional[str] = None
     print_job_id: Optional[str] = None
 
+class InvoiceDetail(BaseModel):
+    invoice_id: str
+    customer_name: str
+    reservation_id: str
+    total: float
+    created_at: datetime
+    items: List[ItemOut]
+
+class InvoiceBatchIn(BaseModel):
+    invoices: List[InvoiceIn] = Field(..., min_items=1, max_items=BATCH_MAX_INVOICES)
+    print_pdfs: bool = False
+
+class InvoiceBatchResult(BaseModel):
+    index: int
+    status: int
+    invoice: Optional[InvoiceOut] = None
+    error: Optional[str] = None
+
+class InvoiceBatchOut(BaseModel):
+    reservation_id: Optional[str] = None
+    created: int
+    failed: int
+    results: List[InvoiceBatchResult]
+
 class InvoiceRow(BaseModel):
     invoice_id: str
     customer_name: str
@@ -87,7 +488,9 @@ class InvoiceRow(BaseModel):
 
 class InvoicesList(BaseModel):
     items: List[InvoiceRow]
-    total: int
+    next_cursor: Optional[str] = None
+    total: Optional[int] = None
+    total_estimated: bool = False
 
 class DailyPoint(BaseModel):
     date: str
@@ -105,40 +508,255 @@ class SalesDailyReport(BaseModel):
 # ------------------------------
 # Helpers
 # ------------------------------
-async def fetch_product_prices() -> dict[str, float]:
-    url = f"{INVENTORY_BASE_URL}/products"
-    async with httpx.AsyncClient(timeout=10) as client:
-        r = await client.get(url)
-        if r.status_code != 200:
-            raise HTTPException(status_code=502, detail="No se pudo consultar productos del inventario")
-        data = r.json()
-        return {p["product_id"]: float(p["price"]) for p in data}
+async def _lookup_prices(product_ids: List[str]) -> dict[str, float]:
+    url = f"{INVENTORY_BASE_URL}/products/lookup"
+    r = await inventory_http.post(url, json={"product_ids": product_ids, "fields": ["price"]})
+    if r.status_code != 200:
+        raise HTTPException(status_code=502, detail="No se pudo consultar productos del inventario")
+    data = r.json()
+    return {p["product_id"]: float(p["price"]) for p in data}
+
+async def fetch_product_prices(product_ids: List[str]) -> dict[str, float]:
+    """Precios desde inventory, en lookups de a lo sumo MAX_LOOKUP_IDS ids (en paralelo)."""
+    ids = list(product_ids)
+    parts = await asyncio.gather(*(
+        _lookup_prices(ids[i:i + MAX_LOOKUP_IDS]) for i in range(0, len(ids), MAX_LOOKUP_IDS)
+    ))
+    prices: dict[str, float] = {}
+    for part in parts:
+        prices.update(part)
+    return prices
 
-async def inventory_reserve(items: List[ItemIn]) -> str:
+async def inventory_reserve(items: List[ItemIn], reservation_id: str):
     url = f"{INVENTORY_BASE_URL}/reserve"
     payload = {
         "request_id": f"req-{uuid.uuid4().hex[:8]}",
-        "items": [{"product_id": it.product_id, "quantity": it.quantity} for it in items]
+        "reservation_id": reservation_id,
+        "items": [{"product_id": it.product_id, "quantity": it.quantity} for it in items],
+        # No vence en inventory: las huérfanas las libera billing (pending_reservations),
+        # así el barrido de inventory nunca devuelve stock de una reserva facturada
+        "expires": False,
     }
-    async with httpx.AsyncClient(timeout=15) as client:
-        r = await client.post(url, json=payload)
-        if r.status_code == 409:
-            raise HTTPException(status_code=409, detail=r.json().get("detail", "Stock insuficiente"))
-        if r.status_code not in (200, 201):
-            raise HTTPException(status_code=502, detail="No se pudo reservar inventario")
-        return r.json()["reservation_id"]
-
-async def inventory_commit(reservation_id: str):
+    r = await inventory_http.post(url, json=payload)
+    if r.status_code == 409:
+        raise HTTPException(status_code=409, detail=r.json().get("detail", "Stock insuficiente"))
+    if r.status_code not in (200, 201):
+        raise HTTPException(status_code=502, detail="No se pudo reservar inventario")
+
+async def reserve_for_invoice(items: List[ItemIn]) -> str:
+    """
+    Registra la reserva en pending_reservations antes de pedirla a inventory:
+    si no llega a tener factura (error, timeout, caída del proceso) la libera
+    release_orphan_reservations.
+    """
+    reservation_id = f"res-{uuid.uuid4().hex}"
+    assert pool is not None
+    async with pool.acquire() as conn:
+        await conn.execute("INSERT INTO pending_reservations (reservation_id) VALUES ($1)", reservation_id)
+    try:
+        await inventory_reserve(items, reservation_id)
+    except HTTPException as e:
+        if e.status_code == 409:
+            # Sin stock: inventory no reservó nada
+            async with pool.acquire() as conn:
+                await conn.execute("DELETE FROM pending_reservations WHERE reservation_id = $1", reservation_id)
+        raise
+    return reservation_id
+
+async def claim_reservation(conn: asyncpg.Connection, reservation_id: str):
+    """
+    En la transacción de la factura: la reserva deja de ser huérfana. Si el
+    barrido de huérfanas ya la liberó (o la tiene tomada) la factura no se guarda.
+    """
+    claimed = await conn.fetchval(
+        "DELETE FROM pending_reservations WHERE reservation_id = $1 RETURNING reservation_id",
+        reservation_id
+    )
+    if claimed is None:
+        raise RuntimeError(f"La reserva {reservation_id} ya fue liberada como huérfana")
+
+async def inventory_commit(reservation_id: str, retries: int = COMMIT_RETRIES):
+    """
+    Confirma la reserva (idempotente en inventory). 409 si inventory la rechaza
+    (no existe, vencida o liberada: no se reintenta); 502 si no se pudo tras los reintentos.
+    """
     url = f"{INVENTORY_BASE_URL}/commit"
     payload = {"reservation_id": reservation_id}
-    async with httpx.AsyncClient(timeout=10) as client:
-        await client.post(url, json=payload)
+    delay = 0.2
+    for attempt in range(retries):
+        try:
+            r = await inventory_http.post(url, json=payload)
+        except httpx.HTTPError as e:
+            error = str(e) or type(e).__name__
+        else:
+            if r.status_code in (200, 201):
+                return
+            if r.status_code in (400, 404):
+                try:
+                    detail = r.json().get("detail") or r.text
+                except Exception:
+                    detail = r.text
+                raise HTTPException(status_code=409, detail=f"Inventory rechazó el commit: {detail}")
+            error = f"HTTP {r.status_code}"
+        if attempt < retries - 1:
+            await asyncio.sleep(delay)
+            delay *= 2
+    raise HTTPException(status_code=502, detail=f"No se pudo confirmar la reserva: {error}")
+
+async def record_pending_commit(conn: asyncpg.Connection, reservation_id: str):
+    """En la transacción de la factura: deja constancia de que falta el commit."""
+    await conn.execute(
+        """
+        INSERT INTO pending_commits (reservation_id, next_attempt_at)
+        VALUES ($1, NOW() + make_interval(secs => $2))
+        ON CONFLICT (reservation_id) DO NOTHING
+        """,
+        reservation_id, COMMIT_RETRY_INTERVAL
+    )
 
-async def inventory_release(reservation_id: str):
+async def commit_reservation(reservation_id: str):
+    """Commit tras guardar la factura; si falla queda en pending_commits para el reintento de fondo."""
+    try:
+        await inventory_commit(reservation_id)
+    except HTTPException as e:
+        logger.warning("Commit de inventario falló para %s, se reintentará: %s", reservation_id, e.detail)
+        return
+    try:
+        assert pool is not None
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM pending_commits WHERE reservation_id = $1", reservation_id)
+    except Exception as e:
+        # El reintento de fondo vuelve a confirmar (idempotente) y borra la fila
+        logger.warning("No se pudo borrar el commit pendiente %s: %s", reservation_id, e)
+
+async def retry_pending_commits() -> int:
+    assert pool is not None
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT reservation_id, attempts FROM pending_commits
+            WHERE status = 'pending' AND next_attempt_at <= NOW()
+            ORDER BY next_attempt_at
+            LIMIT 100
+            """
+        )
+    done = 0
+    for row in rows:
+        reservation_id = row["reservation_id"]
+        try:
+            await inventory_commit(reservation_id, retries=1)
+        except HTTPException as e:
+            async with pool.acquire() as conn:
+                if e.status_code == 409:
+                    # La reserva ya no existe o volvió al stock: requiere revisión manual
+                    logger.error("❌ Reserva %s facturada pero no confirmable: %s", reservation_id, e.detail)
+                    await conn.execute(
+                        "UPDATE pending_commits SET status = 'failed', last_error = $2 WHERE reservation_id = $1",
+                        reservation_id, e.detail
+                    )
+                else:
+                    delay = min(COMMIT_RETRY_INTERVAL * 2 ** row["attempts"], COMMIT_RETRY_MAX_DELAY)
+                    await conn.execute(
+                        """
+                        UPDATE pending_commits
+                        SET attempts = attempts + 1, last_error = $2,
+                            next_attempt_at = NOW() + make_interval(secs => $3)
+                        WHERE reservation_id = $1
+                        """,
+                        reservation_id, e.detail, float(delay)
+                    )
+            continue
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM pending_commits WHERE reservation_id = $1", reservation_id)
+        done += 1
+    return done
+
+async def retry_pending_commits_loop():
+    while True:
+        await asyncio.sleep(COMMIT_RETRY_INTERVAL)
+        try:
+            done = await retry_pending_commits()
+            if done:
+                logger.info("✅ Commits de inventario pendientes confirmados: %s", done)
+        except Exception as e:
+            logger.warning("Reintento de commits pendientes falló: %s", e)
+
+async def inventory_release(reservation_id: str) -> bool:
+    """True si la reserva ya no retiene stock: liberada ahora, inexistente o ya no 'reserved'."""
     url = f"{INVENTORY_BASE_URL}/release"
     payload = {"reservation_id": reservation_id}
-    async with httpx.AsyncClient(timeout=10) as client:
-        await client.post(url, json=payload)
+    try:
+        r = await inventory_http.post(url, json=payload)
+    except httpx.HTTPError as e:
+        logger.warning("No se pudo liberar la reserva %s: %s", reservation_id, e)
+        return False
+    return r.status_code in (200, 201, 400, 404)
+
+async def release_orphan_reservations() -> int:
+    """
+    Libera las reservas de pending_reservations que pasado RESERVATION_ORPHAN_AFTER
+    no tienen factura. Las filas quedan bloqueadas mientras se liberan, así una
+    factura que llega tarde espera y luego falla en claim_reservation.
+    """
+    assert pool is not None
+    released = 0
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            rows = await conn.fetch(
+                """
+                SELECT reservation_id FROM pending_reservations
+                WHERE created_at < NOW() - make_interval(secs => $1)
+                ORDER BY created_at
+                LIMIT 100
+                FOR UPDATE SKIP LOCKED
+                """,
+                RESERVATION_ORPHAN_AFTER
+            )
+            for row in rows:
+                if await inventory_release(row["reservation_id"]):
+                    await conn.execute(
+                        "DELETE FROM pending_reservations WHERE reservation_id = $1", row["reservation_id"]
+                    )
+                    released += 1
+    return released
+
+async def release_orphan_reservations_loop():
+    while True:
+        await asyncio.sleep(RESERVATION_ORPHAN_INTERVAL)
+        try:
+            released = await release_orphan_reservations()
+            if released:
+                logger.info("♻️ Reservas huérfanas liberadas: %s", released)
+        except Exception as e:
+            logger.warning("Liberación de reservas huérfanas falló: %s", e)
+
+invoice_cache = LRUCache(INVOICE_CACHE_MAX_SIZE)
+
+price_cache = PriceCache(
+    fetch_product_prices,
+    ttl=PRICE_CACHE_TTL,
+    max_size=PRICE_CACHE_MAX_SIZE,
+)
+
+CENTS = decimal.Decimal("0.01")
+
+def price_items(items: List[ItemIn], price_map: dict[str, float]) -> tuple[List[ItemOut], decimal.Decimal]:
+    items_out: List[ItemOut] = []
+    total = decimal.Decimal("0.00")
+    for it in items:
+        if it.product_id not in price_map:
+            raise HTTPException(status_code=404, detail=f"Producto {it.product_id} no existe")
+        price = decimal.Decimal(str(price_map[it.product_id]))
+        subtotal = price * decimal.Decimal(it.quantity)
+        total += subtotal
+        items_out.append(ItemOut(
+            product_id=it.product_id,
+            quantity=it.quantity,
+            unit_price=float(price),
+            subtotal=float(subtotal)
+        ))
+    # Redondeado como NUMERIC(12,2) en invoices, para que sales_daily sume lo mismo que se guarda
+    return items_out, total.quantize(CENTS, rounding=decimal.ROUND_HALF_UP)
 
 def build_invoice_payload(
     invoice_id: str,
@@ -163,13 +781,19 @@ def build_invoice_payload(
     }
 
 async def request_print(invoice_id: str, invoice_payload: dict) -> tuple[Optional[str], Optional[str]]:
+    """
+    Con PRINT_ASYNC solo encola el trabajo (pdf_url llega luego por
+    GET /print/jobs/{job_id}); si no, espera a que el PDF esté generado.
+    """
     if not PRINT_BASE_URL:
         return (None, None)
-    url = f"{PRINT_BASE_URL}/print/factura/{invoice_id}"
+    if PRINT_ASYNC:
+        url = f"{PRINT_BASE_URL}/print/jobs/factura/{invoice_id}"
+    else:
+        url = f"{PRINT_BASE_URL}/print/factura/{invoice_id}"
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            r = await client.post(url, json={"invoice": invoice_payload})
-        if r.status_code != 200:
+        r = await print_http.post(url, json={"invoice": invoice_payload})
+        if r.status_code not in (200, 202):
             logger.warning("Printing devolvió %s: %s", r.status_code, r.text)
             return (None, None)
         data = r.json()
@@ -178,35 +802,226 @@ async def request_print(invoice_id: str, invoice_payload: dict) -> tuple[Optiona
         logger.warning("No se pudo solicitar impresión de %s: %s", invoice_id, e)
         return (None, None)
 
+async def add_to_sales_daily(conn: asyncpg.Connection, day: date, total: decimal.Decimal, count: int = 1):
+    """Suma al acumulado del día; debe llamarse dentro de la transacción de la factura."""
+    await conn.execute(
+        """
+        INSERT INTO sales_daily (day, total, invoice_count)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (day) DO UPDATE
+        SET total = sales_daily.total + EXCLUDED.total,
+            invoice_count = sales_daily.invoice_count + EXCLUDED.invoice_count
+        """,
+        day, total, count
+    )
+
+async def backfill_sales_daily(conn: asyncpg.Connection, from_day: Optional[date] = None, to_day: Optional[date] = None) -> int:
+    """
+    Recalcula sales_daily desde invoices para [from_day, to_day] (o todo).
+    Bloquea sales_daily durante el recálculo para no perder facturas concurrentes.
+    """
+    start = datetime(from_day.year, from_day.month, from_day.day, tzinfo=timezone.utc) if from_day else None
+    end = None
+    if to_day:
+        t_next = to_day + timedelta(days=1)
+        end = datetime(t_next.year, t_next.month, t_next.day, tzinfo=timezone.utc)
+
+    async with conn.transaction():
+        await conn.execute("LOCK TABLE sales_daily IN EXCLUSIVE MODE")
+        await conn.execute(
+            """
+            DELETE FROM sales_daily
+            WHERE ($1::date IS NULL OR day >= $1) AND ($2::date IS NULL OR day <= $2)
+            """,
+            from_day, to_day
+        )
+        result = await conn.execute(
+            """
+            INSERT INTO sales_daily (day, total, invoice_count)
+            SELECT DATE(created_at AT TIME ZONE 'UTC'), SUM(total), COUNT(*)
+            FROM invoices
+            WHERE ($1::timestamptz IS NULL OR created_at >= $1)
+              AND ($2::timestamptz IS NULL OR created_at < $2)
+            GROUP BY 1
+            """,
+            start, end
+        )
+    return int(result.split()[-1])
+
+# ------------------------------
+# Idempotencia
+# ------------------------------
+# Peticiones en curso por key en este proceso: las repetidas esperan a la primera
+_idempotency_inflight: dict[str, tuple[asyncio.Task, str]] = {}
+
+def _request_hash(body: BaseModel) -> str:
+    return hashlib.sha256(body.model_dump_json().encode()).hexdigest()
+
+async def _claim_idempotency_key(key: str, request_hash: str) -> Optional[InvoiceOut]:
+    """
+    Reserva la key en Postgres. Devuelve None si esta petición debe ejecutar
+    la creación, o la respuesta guardada si ya se ejecutó antes (aquí o en
+    otra réplica). Si otra réplica la está procesando, espera a que termine;
+    una key 'in_progress' con el lease vencido (proceso caído) se retoma.
+    """
+    assert pool is not None
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    delay = 0.1
+    while True:
+        async with pool.acquire() as conn:
+            # Toma la key si no existe o si venció (respuesta vieja o lease de un proceso caído)
+            claimed = await conn.fetchval(
+                """
+                INSERT INTO idempotency_keys (key, request_hash, status, expires_at)
+                VALUES ($1, $2, 'in_progress', NOW() + make_interval(secs => $3))
+                ON CONFLICT (key) DO UPDATE
+                  SET request_hash = EXCLUDED.request_hash, status = 'in_progress',
+                      response = NULL, created_at = NOW(), expires_at = EXCLUDED.expires_at
+                  WHERE idempotency_keys.expires_at < NOW()
+                RETURNING key
+                """,
+                key, request_hash, IDEMPOTENCY_LEASE
+            )
+            if claimed:
+                return None
+            row = await conn.fetchrow(
+                "SELECT request_hash, status, response FROM idempotency_keys WHERE key = $1", key
+            )
+        if row is None:
+            continue  # se liberó entre el INSERT y el SELECT
+        if row["request_hash"] != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key ya usada con otro cuerpo")
+        if row["status"] == "done":
+            response = row["response"]
+            if isinstance(response, str):
+                response = json.loads(response)
+            return InvoiceOut.model_validate(response)
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=409, detail="Petición con esta Idempotency-Key aún en proceso")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 1.0)
+
+async def _store_idempotent_response(key: str, out: InvoiceOut):
+    assert pool is not None
+    async with pool.acquire() as conn:
+        await conn.execute(
+            """
+            UPDATE idempotency_keys
+            SET status = 'done', response = $2::jsonb, expires_at = NOW() + make_interval(secs => $3)
+            WHERE key = $1
+            """,
+            key, out.model_dump_json(), float(IDEMPOTENCY_TTL)
+        )
+
+async def _release_idempotency_key(key: str):
+    assert pool is not None
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "DELETE FROM idempotency_keys WHERE key = $1 AND status = 'in_progress'", key
+        )
+
+async def _run_idempotent(key: str, request_hash: str, body: InvoiceIn) -> tuple[InvoiceOut, bool]:
+    """Devuelve (factura, replayed)."""
+    stored = await _claim_idempotency_key(key, request_hash)
+    if stored is not None:
+        return stored, True
+    try:
+        out = await _crear_factura(body)
+    except BaseException:
+        # No se guardan errores: el cliente puede reintentar con la misma key
+        try:
+            await _release_idempotency_key(key)
+        except Exception:
+            logger.warning("No se pudo liberar la Idempotency-Key %s", key)
+        raise
+    try:
+        await _store_idempotent_response(key, out)
+    except Exception:
+        logger.exception("No se pudo guardar la respuesta de la Idempotency-Key %s", key)
+    return out, False
+
+async def purge_idempotency_keys_loop():
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_PURGE_INTERVAL)
+        try:
+            assert pool is not None
+            async with pool.acquire() as conn:
+                await conn.execute("DELETE FROM idempotency_keys WHERE expires_at < NOW()")
+        except Exception as e:
+            logger.warning("Limpieza de idempotency_keys falló: %s", e)
+
+def _encode_cursor(created_at: datetime, invoice_id) -> str:
+    raw = json.dumps([created_at.isoformat(), str(invoice_id)]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(cursor: str) -> tuple[datetime, uuid.UUID]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, invoice_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), uuid.UUID(invoice_id)
+    except Exception:
+        raise HTTPException(status_code=422, detail="Cursor inválido")
+
 def _parse_date(d: str) -> date:
     try:
         return datetime.strptime(d, "%Y-%m-%d").date()
     except Exception:
         raise HTTPException(status_code=422, detail="Fecha inválida. Formato esperado YYYY-MM-DD")
 
+# ------------------------------
+# Métricas
+# ------------------------------
+@app.get("/billing/metrics")
+async def metricas():
+    return {
+        "upstreams": {u.name: u.stats() for u in UPSTREAMS},
+        "price_cache": price_cache.stats(),
+        "invoice_cache": invoice_cache.stats(),
+    }
+
+@app.delete("/billing/cache/precios")
+async def invalidar_cache_precios(product_id: Optional[List[str]] = Query(None)):
+    """
+    Invalida el cache de precios. Sin parámetros vacía todo;
+    con ?product_id=A&product_id=B solo esos productos.
+    """
+    removed = price_cache.invalidate(product_id)
+    return {"invalidated": removed}
+
 # ------------------------------
 # Crear factura
 # ------------------------------
 @app.post("/billing/facturas", response_model=InvoiceOut, status_code=201)
-async def crear_factura(body: InvoiceIn):
-    price_map = await fetch_product_prices()
+async def crear_factura(
+    body: InvoiceIn,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=255),
+):
+    if not idempotency_key:
+        return await _crear_factura(body)
 
-    items_out: List[ItemOut] = []
-    total = decimal.Decimal("0.00")
-    for it in body.items:
-        if it.product_id not in price_map:
-            raise HTTPException(status_code=404, detail=f"Producto {it.product_id} no existe")
-        price = decimal.Decimal(str(price_map[it.product_id]))
-        subtotal = price * decimal.Decimal(it.quantity)
-        total += subtotal
-        items_out.append(ItemOut(
-            product_id=it.product_id,
-            quantity=it.quantity,
-            unit_price=float(price),
-            subtotal=float(subtotal)
-        ))
+    request_hash = _request_hash(body)
+    inflight = _idempotency_inflight.get(idempotency_key)
+    if inflight is None:
+        task = asyncio.create_task(_run_idempotent(idempotency_key, request_hash, body))
+        _idempotency_inflight[idempotency_key] = (task, request_hash)
+        task.add_done_callback(lambda _: _idempotency_inflight.pop(idempotency_key, None))
+    else:
+        task, first_hash = inflight
+        if first_hash != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key ya usada con otro cuerpo")
+
+    # shield: si este cliente se desconecta, la creación sigue para los demás
+    out, replayed = await asyncio.shield(task)
+    if replayed or inflight is not None:
+        response.headers["Idempotent-Replayed"] = "true"
+    return out
+
+async def _crear_factura(body: InvoiceIn) -> InvoiceOut:
+    price_map = await price_cache.get_many(it.product_id for it in body.items)
+    items_out, total = price_items(body.items, price_map)
 
-    reservation_id = await inventory_reserve(body.items)
+    reservation_id = await reserve_for_invoice(body.items)
 
     invoice_id = str(uuid.uuid4())
     created_at = datetime.now(timezone.utc)
@@ -228,6 +1043,10 @@ async def crear_factura(body: InvoiceIn):
                     """,
                     [(invoice_id, io.product_id, io.quantity, io.unit_price, io.subtotal) for io in items_out]
                 )
+                await add_to_sales_daily(conn, created_at.date(), total)
+                await claim_reservation(conn, reservation_id)
+                if COMMIT_AFTER_CREATE:
+                    await record_pending_commit(conn, reservation_id)
     except Exception as e:
         logger.exception("Error guardando factura en DB, se libera la reserva: %s", e)
         try:
@@ -236,10 +1055,7 @@ async def crear_factura(body: InvoiceIn):
             raise HTTPException(status_code=500, detail="No se pudo guardar la factura")
 
     if COMMIT_AFTER_CREATE:
-        try:
-            await inventory_commit(reservation_id)
-        except Exception:
-            logger.warning("Commit de inventario falló (continuamos)")
+        await commit_reservation(reservation_id)
 
     pdf_url: Optional[str] = None
     print_job_id: Optional[str] = None
@@ -259,6 +1075,116 @@ async def crear_factura(body: InvoiceIn):
         print_job_id=print_job_id
     )
 
+# ------------------------------
+# Crear facturas en lote
+# ------------------------------
+@app.post("/billing/facturas/batch", response_model=InvoiceBatchOut)
+async def crear_facturas_lote(body: InvoiceBatchIn):
+    """
+    Crea N facturas con una sola consulta de precios, una sola reserva de
+    inventario (por las cantidades agregadas) y una sola transacción con COPY.
+    Las facturas con productos inexistentes se reportan y no se crean;
+    si falta stock para el lote, ninguna se crea.
+    """
+    price_map = await price_cache.get_many(
+        it.product_id for inv in body.invoices for it in inv.items
+    )
+
+    results: List[Optional[InvoiceBatchResult]] = [None] * len(body.invoices)
+    priced: List[tuple[int, InvoiceIn, List[ItemOut], decimal.Decimal]] = []
+    for idx, inv in enumerate(body.invoices):
+        try:
+            items_out, total = price_items(inv.items, price_map)
+        except HTTPException as e:
+            results[idx] = InvoiceBatchResult(index=idx, status=e.status_code, error=e.detail)
+            continue
+        priced.append((idx, inv, items_out, total))
+
+    reservation_id: Optional[str] = None
+    if priced:
+        quantities: dict[str, int] = {}
+        for _, inv, _, _ in priced:
+            for it in inv.items:
+                quantities[it.product_id] = quantities.get(it.product_id, 0) + it.quantity
+        try:
+            reservation_id = await reserve_for_invoice(
+                [ItemIn(product_id=pid, quantity=qty) for pid, qty in quantities.items()]
+            )
+        except HTTPException as e:
+            for idx, _, _, _ in priced:
+                results[idx] = InvoiceBatchResult(index=idx, status=e.status_code, error=e.detail)
+            priced = []
+
+    created: List[tuple[int, InvoiceOut, InvoiceIn, decimal.Decimal]] = []
+    if priced:
+        created_at = datetime.now(timezone.utc)
+        invoice_rows = []
+        item_rows = []
+        for idx, inv, items_out, total in priced:
+            invoice_id = str(uuid.uuid4())
+            invoice_rows.append((invoice_id, inv.customer_name, reservation_id, total, created_at))
+            item_rows.extend(
+                (invoice_id, io.product_id, io.quantity, io.unit_price, io.subtotal) for io in items_out
+            )
+            created.append((idx, InvoiceOut(
+                invoice_id=invoice_id,
+                reservation_id=reservation_id,
+                total=float(total),
+                items=items_out,
+                created_at=created_at,
+            ), inv, total))
+        try:
+            assert pool is not None
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.copy_records_to_table(
+                        "invoices",
+                        records=invoice_rows,
+                        columns=["id", "customer_name", "reservation_id", "total", "created_at"],
+                    )
+                    await conn.copy_records_to_table(
+                        "invoice_items",
+                        records=item_rows,
+                        columns=["invoice_id", "product_id", "quantity", "unit_price", "subtotal"],
+                    )
+                    await add_to_sales_daily(
+                        conn, created_at.date(), sum(t for _, _, _, t in created), len(created)
+                    )
+                    await claim_reservation(conn, reservation_id)
+                    if COMMIT_AFTER_CREATE:
+                        await record_pending_commit(conn, reservation_id)
+        except Exception as e:
+            logger.exception("Error guardando lote de facturas en DB, se libera la reserva: %s", e)
+            try:
+                await inventory_release(reservation_id)
+            finally:
+                raise HTTPException(status_code=500, detail="No se pudo guardar el lote de facturas")
+
+        if COMMIT_AFTER_CREATE:
+            await commit_reservation(reservation_id)
+
+        if body.print_pdfs:
+            prints = await asyncio.gather(*(
+                request_print(
+                    out.invoice_id,
+                    build_invoice_payload(out.invoice_id, inv, out.items, total, reservation_id),
+                )
+                for _, out, inv, total in created
+            ))
+            for (_, out, _, _), (pdf_url, print_job_id) in zip(created, prints):
+                out.pdf_url = pdf_url
+                out.print_job_id = print_job_id
+
+        for idx, out, _, _ in created:
+            results[idx] = InvoiceBatchResult(index=idx, status=201, invoice=out)
+
+    return InvoiceBatchOut(
+        reservation_id=reservation_id,
+        created=len(created),
+        failed=len(body.invoices) - len(created),
+        results=results,
+    )
+
 # ------------------------------
 # Listado de facturas (filtros)
 # ------------------------------
@@ -266,8 +1192,9 @@ async def crear_factura(body: InvoiceIn):
 async def listar_facturas(
     from_date: str = Query(..., description="YYYY-MM-DD"),
     to_date: str = Query(..., description="YYYY-MM-DD"),
-    page: int = Query(1, ge=1),
     page_size: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = Query(None, description="next_cursor de la página anterior"),
+    count: Literal["none", "exact", "estimated"] = Query("none", description="Cálculo del total"),
 ):
     f = _parse_date(from_date)
     t = _parse_date(to_date)
@@ -275,42 +1202,249 @@ async def listar_facturas(
         raise HTTPException(status_code=422, detail="from_date no puede ser mayor que to_date")
     # rango [f, t+1)
     t_next = t + timedelta(days=1)
+    start = datetime(f.year, f.month, f.day, tzinfo=timezone.utc)
+    end = datetime(t_next.year, t_next.month, t_next.day, tzinfo=timezone.utc)
 
-    offset = (page - 1) * page_size
-
+    # Paginación por llave (created_at, id): cada página es un range scan
+    # sobre idx_invoices_created_at_id, sin importar qué tan profunda sea.
     assert pool is not None
     async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT id, customer_name, total, created_at
-            FROM invoices
-            WHERE created_at >= $1 AND created_at < $2
-            ORDER BY created_at ASC
-            LIMIT $3 OFFSET $4
-            """,
-            datetime(f.year, f.month, f.day, tzinfo=timezone.utc),
-            datetime(t_next.year, t_next.month, t_next.day, tzinfo=timezone.utc),
-            page_size, offset
-        )
-        total_count = await conn.fetchval(
-            """
-            SELECT COUNT(*) FROM invoices
-            WHERE created_at >= $1 AND created_at < $2
-            """,
-            datetime(f.year, f.month, f.day, tzinfo=timezone.utc),
-            datetime(t_next.year, t_next.month, t_next.day, tzinfo=timezone.utc),
-        )
+        if cursor:
+            after_created_at, after_id = _decode_cursor(cursor)
+            rows = await conn.fetch(
+                """
+                SELECT id, customer_name, total, created_at
+                FROM invoices
+                WHERE created_at >= $1 AND created_at < $2
+                  AND (created_at, id) > ($3, $4)
+                ORDER BY created_at ASC, id ASC
+                LIMIT $5
+                """,
+                start, end, after_created_at, after_id, page_size + 1
+            )
+        else:
+            rows = await conn.fetch(
+                """
+                SELECT id, customer_name, total, created_at
+                FROM invoices
+                WHERE created_at >= $1 AND created_at < $2
+                ORDER BY created_at ASC, id ASC
+                LIMIT $3
+                """,
+                start, end, page_size + 1
+            )
+
+        total_count: Optional[int] = None
+        if count == "exact":
+            total_count = await conn.fetchval(
+                """
+                SELECT COUNT(*) FROM invoices
+                WHERE created_at >= $1 AND created_at < $2
+                """,
+                start, end,
+            )
+        elif count == "estimated":
+            # Estimación del planner: no recorre las filas
+            plan = await conn.fetchval(
+                """
+                EXPLAIN (FORMAT JSON)
+                SELECT 1 FROM invoices
+                WHERE created_at >= $1 AND created_at < $2
+                """,
+                start, end,
+            )
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            total_count = int(plan[0]["Plan"]["Plan Rows"])
+
+    next_cursor: Optional[str] = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = _encode_cursor(last["created_at"], last["id"])
 
     items = [
         InvoiceRow(
-            invoice_id=r["id"],
+            invoice_id=str(r["id"]),
             customer_name=r["customer_name"],
             total=float(r["total"]),
             created_at=r["created_at"],
         )
         for r in rows
     ]
-    return InvoicesList(items=items, total=int(total_count))
+    return InvoicesList(
+        items=items,
+        next_cursor=next_cursor,
+        total=int(total_count) if total_count is not None else None,
+        total_estimated=(count == "estimated"),
+    )
+
+# ------------------------------
+# Exportación de facturas (streaming)
+# ------------------------------
+EXPORT_COLUMNS = [
+    "invoice_id", "created_at", "customer_name", "reservation_id", "invoice_total",
+    "product_id", "quantity", "unit_price", "subtotal",
+]
+
+_export_slots = asyncio.Semaphore(EXPORT_MAX_CONCURRENT)
+
+async def _export_rows(start: datetime, end: datetime) -> AsyncIterator[asyncpg.Record]:
+    """
+    Recorre facturas + ítems con un cursor del servidor (memoria constante).
+    Usa una conexión propia: una descarga lenta no ocupa el pool de las facturas.
+    """
+    async with _export_slots:
+        conn = await asyncpg.connect(**_pg_params())
+        try:
+            async with conn.transaction(readonly=True):
+                async for r in conn.cursor(
+                    """
+                    SELECT i.id, i.created_at, i.customer_name, i.reservation_id, i.total,
+                           it.product_id, it.quantity, it.unit_price, it.subtotal
+                    FROM invoices i
+                    JOIN invoice_items it ON it.invoice_id = i.id
+                    WHERE i.created_at >= $1 AND i.created_at < $2
+                    ORDER BY i.created_at, i.id, it.id
+                    """,
+                    start, end,
+                    prefetch=EXPORT_PREFETCH,
+                ):
+                    yield r
+        finally:
+            await conn.close()
+
+async def _export_csv(start: datetime, end: datetime) -> AsyncIterator[str]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_COLUMNS)
+    # la cabecera sale de inmediato, antes de la primera fila
+    yield buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    pending = 0
+    async for r in _export_rows(start, end):
+        writer.writerow([
+            r["id"], r["created_at"].isoformat(), r["customer_name"], r["reservation_id"], r["total"],
+            r["product_id"], r["quantity"], r["unit_price"], r["subtotal"],
+        ])
+        pending += 1
+        if pending >= EXPORT_CHUNK_ROWS:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            pending = 0
+    if pending:
+        yield buf.getvalue()
+
+async def _export_ndjson(start: datetime, end: datetime) -> AsyncIterator[str]:
+    """Una línea por factura con sus ítems; las filas llegan agrupadas por el ORDER BY."""
+    lines: List[str] = []
+    current: Optional[dict] = None
+    async for r in _export_rows(start, end):
+        invoice_id = str(r["id"])
+        if current is None or current["invoice_id"] != invoice_id:
+            if current is not None:
+                lines.append(json.dumps(current))
+                if len(lines) >= EXPORT_CHUNK_ROWS:
+                    yield "\n".join(lines) + "\n"
+                    lines = []
+            current = {
+                "invoice_id": invoice_id,
+                "created_at": r["created_at"].isoformat(),
+                "customer_name": r["customer_name"],
+                "reservation_id": r["reservation_id"],
+                "total": float(r["total"]),
+                "items": [],
+            }
+        current["items"].append({
+            "product_id": r["product_id"],
+            "quantity": r["quantity"],
+            "unit_price": float(r["unit_price"]),
+            "subtotal": float(r["subtotal"]),
+        })
+    if current is not None:
+        lines.append(json.dumps(current))
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+@app.get("/billing/facturas/export")
+async def exportar_facturas(
+    from_date: str = Query(..., description="YYYY-MM-DD"),
+    to_date: str = Query(..., description="YYYY-MM-DD"),
+    format: Literal["csv", "ndjson"] = Query("csv"),
+):
+    f = _parse_date(from_date)
+    t = _parse_date(to_date)
+    if f > t:
+        raise HTTPException(status_code=422, detail="from_date no puede ser mayor que to_date")
+    if (t - f).days + 1 > EXPORT_MAX_DAYS:
+        raise HTTPException(status_code=422, detail=f"Rango máximo de exportación: {EXPORT_MAX_DAYS} días")
+    if _export_slots.locked():
+        raise HTTPException(
+            status_code=503,
+            detail="Demasiadas exportaciones en curso, reintenta en un momento",
+            headers={"Retry-After": "30"},
+        )
+    t_next = t + timedelta(days=1)
+    start = datetime(f.year, f.month, f.day, tzinfo=timezone.utc)
+    end = datetime(t_next.year, t_next.month, t_next.day, tzinfo=timezone.utc)
+
+    filename = f"facturas_{f.isoformat()}_{t.isoformat()}.{format}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if format == "csv":
+        return StreamingResponse(_export_csv(start, end), media_type="text/csv; charset=utf-8", headers=headers)
+    return StreamingResponse(_export_ndjson(start, end), media_type="application/x-ndjson", headers=headers)
+
+# ------------------------------
+# Detalle de factura
+# ------------------------------
+@app.get("/billing/facturas/{invoice_id}", response_model=InvoiceDetail)
+async def obtener_factura(invoice_id: uuid.UUID):
+    cached = invoice_cache.get(invoice_id)
+    if cached is not None:
+        return cached
+
+    # Factura + ítems en una sola consulta (usa idx_invoice_items_invoice_id)
+    assert pool is not None
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT i.id, i.customer_name, i.reservation_id, i.total, i.created_at,
+                   COALESCE(
+                     json_agg(
+                       json_build_object(
+                         'product_id', it.product_id,
+                         'quantity', it.quantity,
+                         'unit_price', it.unit_price,
+                         'subtotal', it.subtotal
+                       ) ORDER BY it.id
+                     ) FILTER (WHERE it.id IS NOT NULL),
+                     '[]'
+                   ) AS items
+            FROM invoices i
+            LEFT JOIN invoice_items it ON it.invoice_id = i.id
+            WHERE i.id = $1
+            GROUP BY i.id
+            """,
+            invoice_id
+        )
+    if row is None:
+        raise HTTPException(status_code=404, detail="Factura no encontrada")
+
+    items = row["items"]
+    if isinstance(items, str):
+        items = json.loads(items)
+    detail = InvoiceDetail(
+        invoice_id=str(row["id"]),
+        customer_name=row["customer_name"],
+        reservation_id=row["reservation_id"],
+        total=float(row["total"]),
+        created_at=row["created_at"],
+        items=[ItemOut(**it) for it in items],
+    )
+    invoice_cache.put(invoice_id, detail)
+    return detail
 
 # ------------------------------
 # Reporte: ventas por día
@@ -329,22 +1463,18 @@ async def reporte_ventas_diarias(
     if (t - f).days > 366:
         raise HTTPException(status_code=422, detail="Rango demasiado grande (máximo 366 días)")
 
-    t_next = t + timedelta(days=1)
-
+    # Lee el acumulado diario (O(días)); se mantiene en crear_factura
+    # y se reconstruye con: python main.py backfill-sales-daily
     assert pool is not None
     async with pool.acquire() as conn:
         rows = await conn.fetch(
             """
-            SELECT DATE(created_at AT TIME ZONE 'UTC') AS d,
-                   SUM(total) AS total,
-                   COUNT(*) AS cnt
-            FROM invoices
-            WHERE created_at >= $1 AND created_at < $2
-            GROUP BY 1
-            ORDER BY 1
+            SELECT day AS d, total, invoice_count AS cnt
+            FROM sales_daily
+            WHERE day >= $1 AND day <= $2
+            ORDER BY day
             """,
-            datetime(f.year, f.month, f.day, tzinfo=timezone.utc),
-            datetime(t_next.year, t_next.month, t_next.day, tzinfo=timezone.utc),
+            f, t,
         )
 
     days: List[DailyPoint] = []
@@ -378,3 +1508,31 @@ async def reporte_ventas_diarias(
         days=days,
         summary=summary
     )
+
+# ------------------------------
+# CLI de mantenimiento
+# ------------------------------
+async def _cli_backfill_sales_daily(from_date: Optional[str], to_date: Optional[str]):
+    f = datetime.strptime(from_date, "%Y-%m-%d").date() if from_date else None
+    t = datetime.strptime(to_date, "%Y-%m-%d").date() if to_date else None
+    conn = await asyncpg.connect(**_pg_params())
+    try:
+        for ddl in SCHEMA_MIGRATIONS:
+            await conn.execute(ddl)
+        days = await backfill_sales_daily(conn, f, t)
+        print(f"✅ sales_daily reconstruida: {days} días")
+    finally:
+        await conn.close()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Tareas de mantenimiento de billing-service")
+    sub = parser.add_subparsers(dest="command", required=True)
+    bf = sub.add_parser("backfill-sales-daily", help="Recalcula sales_daily desde invoices")
+    bf.add_argument("--from-date", help="YYYY-MM-DD (por defecto: desde el inicio)")
+    bf.add_argument("--to-date", help="YYYY-MM-DD (por defecto: hasta hoy)")
+    args = parser.parse_args()
+
+    if args.command == "backfill-sales-daily":
+        asyncio.run(_cli_backfill_sales_daily(args.from_date, args.to_date))
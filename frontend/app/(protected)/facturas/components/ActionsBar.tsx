@@ -34,9 +34,30 @@ async function postInvoice(payload: {
     items: Array<{ product_id: string; quantity: number; unit_price: number; subtotal: number }>;
     /** opcional si tu /api/invoices ya invoca printing y devuelve url */
     pdf_url?: string; // p.ej. "/files/fac-123.pdf"
+    /** si la impresión es asíncrona, se consulta con waitForPdf */
+    print_job_id?: string;
   }>;
 }
 
+/** Helper: espera a que el trabajo de impresión termine y devuelve su pdf_url */
+async function waitForPdf(jobId: string, timeoutMs = 15_000): Promise<string | null> {
+  const deadline = Date.now() + timeoutMs;
+  let delay = 300;
+  while (Date.now() < deadline) {
+    try {
+      const res = await fetch(`/api/print/jobs/${encodeURIComponent(jobId)}`, { cache: "no-store" });
+      if (res.ok) {
+        const job = await res.json();
+        if (job?.status === "completed") return job?.pdf_url ?? null;
+        if (job?.status === "failed") return null;
+      }
+    } catch {}
+    await new Promise((r) => setTimeout(r, delay));
+    delay = Math.min(delay * 2, 2000);
+  }
+  return null;
+}
+
 export default function ActionsBar() {
   const { dispatch, generateId, state } = useInvoice();
   const [lastPdfUrl, setLastPdfUrl] = useState<string | null>(null);
@@ -74,8 +95,9 @@ export default function ActionsBar() {
 
       // Si el backend retornó pdf_url, la proxificamos para abrirla en este dominio
       let proxiedUrl: string | null = null;
-      if (resp?.pdf_url && resp.pdf_url.startsWith("/")) {
-        proxiedUrl = "/api/print" + resp.pdf_url; // => /api/print/files/...
+      const pdfUrl = resp?.pdf_url ?? (resp?.print_job_id ? await waitForPdf(resp.print_job_id) : null);
+      if (pdfUrl && pdfUrl.startsWith("/")) {
+        proxiedUrl = "/api/print" + pdfUrl; // => /api/print/files/...
         setLastPdfUrl(proxiedUrl);
       } else {
         setLastPdfUrl(null);
@@ -17,12 +17,15 @@ export default function UsersTable({
   const [remote, setRemote] = useState<UserRow[]>([]);
   const [loadingRemote, setLoadingRemote] = useState<boolean>(false);
   const [error, setError] = useState<string | null>(null);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
 
-  const loadRemote = async () => {
+  // Sin cursor recarga desde la primera página; con cursor agrega la siguiente
+  const loadRemote = async (cursor: string | null = null) => {
     setError(null);
     setLoadingRemote(true);
     try {
-      const res = await fetch("/api/users", { method: "GET", cache: "no-store" });
+      const url = cursor ? `/api/users?cursor=${encodeURIComponent(cursor)}` : "/api/users";
+      const res = await fetch(url, { method: "GET", cache: "no-store" });
       if (!res.ok) {
         let msg = "Error listando usuarios";
         if (res.status === 401) msg = "Sesión inválida o expirada.";
@@ -34,14 +37,14 @@ export default function UsersTable({
         throw new Error(msg);
       }
       const data = (await res.json()) as Array<{ username: string; role: string }>;
-      setRemote(
-        Array.isArray(data)
-          ? data.map((u) => ({ username: String(u.username), role: String(u.role) }))
-          : []
-      );
+      const page = Array.isArray(data)
+        ? data.map((u) => ({ username: String(u.username), role: String(u.role) }))
+        : [];
+      setRemote((prev) => (cursor ? [...prev, ...page] : page));
+      setNextCursor(res.headers.get("x-next-cursor"));
     } catch (e: any) {
       setError(e?.message || "No se pudo cargar la lista de usuarios.");
-      setRemote([]);
+      if (!cursor) setRemote([]);
     } finally {
       setLoadingRemote(false);
     }
@@ -80,7 +83,7 @@ export default function UsersTable({
         </div>
 
         <button
-          onClick={loadRemote}
+          onClick={() => loadRemote()}
           className="rounded-lg border px-3 py-1.5 text-xs font-medium hover:bg-slate-50"
         >
           Actualizar
@@ -115,6 +118,15 @@ export default function UsersTable({
           </tbody>
         </table>
       </div>
+
+      {nextCursor && (
+        <button
+          onClick={() => loadRemote(nextCursor)}
+          className="rounded-lg border px-3 py-1.5 text-xs font-medium hover:bg-slate-50"
+        >
+          Cargar más
+        </button>
+      )}
     </div>
   );
 }
@@ -40,19 +40,42 @@ function jsonError(message: string, status = 400) {
 }
 
 /* ---------- GET /api/inventory/products ---------- */
-/* Lista productos. Si hay token, lo reenvía como Bearer (no es obligatorio para tu backend). */
+/* Lista productos. Si hay token, lo reenvía como Bearer (no es obligatorio para tu backend).
+   Con ?ids=A,B,C solo trae esos productos (POST /products/lookup) en vez del catálogo completo.
+   limit, cursor, q, low_stock y fields se reenvían tal cual; la siguiente página llega en X-Next-Cursor. */
 export async function GET(req: NextRequest) {
   try {
     const token = req.cookies.get(AUTH_COOKIE)?.value;
+    const auth: Record<string, string> = token ? { Authorization: `Bearer ${token}` } : {};
+
+    const { searchParams } = new URL(req.url);
+    const ids = (searchParams.get("ids") ?? "")
+      .split(",")
+      .map((s) => s.trim())
+      .filter(Boolean);
 
     const ac = new AbortController();
     const t = setTimeout(() => ac.abort(), 10_000);
 
-    const upstream = await fetch(`${INVENTORY_BASE}/products`, {
-      method: "GET",
-      headers: token ? { Authorization: `Bearer ${token}` } : {},
-      signal: ac.signal,
-    }).catch((e) => {
+    const init: RequestInit = ids.length
+      ? {
+          method: "POST",
+          headers: { "Content-Type": "application/json", ...auth },
+          body: JSON.stringify({ product_ids: ids }),
+          signal: ac.signal,
+        }
+      : { method: "GET", headers: auth, signal: ac.signal };
+
+    const forwarded = new URLSearchParams();
+    for (const key of ["limit", "cursor", "q", "low_stock", "fields"]) {
+      const value = searchParams.get(key);
+      if (value) forwarded.set(key, value);
+    }
+    const qs = forwarded.toString();
+    const url = ids.length
+      ? `${INVENTORY_BASE}/products/lookup`
+      : `${INVENTORY_BASE}/products${qs ? `?${qs}` : ""}`;
+    const upstream = await fetch(url, init).catch((e) => {
       throw new Error(`Conexión con Inventory: ${e?.message || e}`);
     });
     clearTimeout(t);
@@ -68,7 +91,10 @@ export async function GET(req: NextRequest) {
       return jsonError(msg, upstream.status);
     }
 
-    return NextResponse.json(payload);
+    const nextCursor = upstream.headers.get("x-next-cursor");
+    return NextResponse.json(payload, {
+      headers: nextCursor ? { "X-Next-Cursor": nextCursor } : undefined,
+    });
   } catch (e: any) {
     return jsonError(e?.message || "No se pudo consultar inventario", 502);
   }
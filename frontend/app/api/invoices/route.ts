@@ -85,10 +85,11 @@ export async function POST(req: NextRequest) {
  *  Query:
  *   from_date=YYYY-MM-DD  (obligatorio)
  *   to_date=YYYY-MM-DD    (obligatorio)
- *   page=1                (opcional)
  *   page_size=50          (opcional)
+ *   cursor=...            (opcional: next_cursor de la página anterior)
+ *   count=none|exact|estimated (opcional)
  *  Respuesta (proxy):
- *   { items:[{invoice_id,customer_name,total,created_at}], total }
+ *   { items:[{invoice_id,customer_name,total,created_at}], next_cursor, total, total_estimated }
  * ------------------------- */
 export async function GET(req: NextRequest) {
   const bearer = getBearer(req);
@@ -97,19 +98,22 @@ export async function GET(req: NextRequest) {
   const { searchParams } = new URL(req.url);
   const from_date = searchParams.get("from_date");
   const to_date = searchParams.get("to_date");
-  const page = searchParams.get("page") ?? "1";
   const page_size = searchParams.get("page_size") ?? "50";
+  const cursor = searchParams.get("cursor");
+  const count = searchParams.get("count");
 
   if (!from_date || !to_date) {
     return jsonError("from_date y to_date son requeridos (YYYY-MM-DD)", 400);
   }
 
-  const qs = new URLSearchParams({
+  const params = new URLSearchParams({
     from_date,
     to_date,
-    page,
     page_size,
-  }).toString();
+  });
+  if (cursor) params.set("cursor", cursor);
+  if (count) params.set("count", count);
+  const qs = params.toString();
 
   try {
     const ac = new AbortController();
@@ -0,0 +1,40 @@
+import { NextRequest, NextResponse } from "next/server";
+
+export const runtime = "nodejs";
+export const dynamic = "force-dynamic";
+
+const PRINT_BASE = process.env.PRINT_BASE ?? "http://print-service:4004";
+
+function jsonError(message: string, status = 400) {
+  return NextResponse.json({ message }, { status });
+}
+
+/* Estado de un trabajo de impresión asíncrono: { job_id, status, pdf_url, ... } */
+export async function GET(
+  req: NextRequest,
+  { params }: { params: { job_id: string } }
+) {
+  const { job_id } = params;
+  if (!job_id) return jsonError("Falta job_id en la ruta", 400);
+
+  try {
+    const upstream = await fetch(`${PRINT_BASE}/print/jobs/${encodeURIComponent(job_id)}`, {
+      method: "GET",
+      cache: "no-store",
+    });
+
+    if (!upstream.ok) {
+      let msg = upstream.statusText;
+      try {
+        const e = await upstream.json();
+        msg = e?.detail || e?.message || msg;
+      } catch {}
+      return jsonError(msg || "Error consultando impresión", upstream.status);
+    }
+
+    const data = await upstream.json();
+    return NextResponse.json(data);
+  } catch (e: any) {
+    return jsonError(e?.message || "No se pudo contactar al Print Service", 502);
+  }
+}
@@ -18,13 +18,22 @@ function getBearerFromCookie(req: NextRequest): string | null {
  * GET /api/users
  * Reenvía a GET http://localhost:8000/auth/users
  * (Backend exige rol admin)
+ * limit, cursor y q (prefijo de username) se reenvían; la siguiente página llega en X-Next-Cursor.
  */
 export async function GET(req: NextRequest) {
   const bearer = getBearerFromCookie(req);
   if (!bearer) return jsonError("No autenticado", 401);
 
+  const { searchParams } = new URL(req.url);
+  const forwarded = new URLSearchParams();
+  for (const key of ["limit", "cursor", "q"]) {
+    const value = searchParams.get(key);
+    if (value) forwarded.set(key, value);
+  }
+  const qs = forwarded.toString();
+
   try {
-    const res = await fetch(`${AUTH_BASE}/users`, {
+    const res = await fetch(`${AUTH_BASE}/users${qs ? `?${qs}` : ""}`, {
       method: "GET",
       headers: {
         Authorization: bearer,
@@ -47,7 +56,10 @@ export async function GET(req: NextRequest) {
     }
 
     const data = await res.json();
-    return NextResponse.json(data);
+    const nextCursor = res.headers.get("x-next-cursor");
+    return NextResponse.json(data, {
+      headers: nextCursor ? { "X-Next-Cursor": nextCursor } : undefined,
+    });
   } catch (e: any) {
     return jsonError(e?.message || "Fallo de red al consultar usuarios", 500);
   }
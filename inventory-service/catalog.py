@@ -0,0 +1,107 @@
+import os
+import time
+import asyncio
+import hashlib
+from typing import Optional
+
+from pymongo import ReturnDocument
+
+# Cada cuánto se relee la versión desde Mongo (para ver los cambios de otras réplicas).
+# 0 = solo memoria (una única instancia).
+CATALOG_VERSION_REFRESH = float(os.getenv("CATALOG_VERSION_REFRESH", "1.0"))  # s
+
+
+class CatalogVersion:
+    """
+    Versión monotónica del catálogo, persistida en db.meta y cacheada en memoria.
+    Se incrementa con cada cambio de productos/stock; el listado la usa como ETag
+    y guarda el cuerpo serializado del catálogo completo por versión.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._checked_at = 0.0
+        self._body: Optional[tuple[int, bytes]] = None
+        self._building: dict[int, asyncio.Task] = {}
+        self.not_modified = 0
+        self.body_hits = 0
+        self.body_misses = 0
+        self.body_shared = 0
+
+    async def load(self, db):
+        doc = await db.meta.find_one({"_id": "catalog"}, {"version": 1})
+        self.version = max(self.version, int(doc["version"]) if doc else 0)
+        self._checked_at = time.monotonic()
+
+    async def current(self, db) -> int:
+        if CATALOG_VERSION_REFRESH > 0 and time.monotonic() - self._checked_at >= CATALOG_VERSION_REFRESH:
+            await self.load(db)
+        return self.version
+
+    async def bump(self, db) -> int:
+        doc = await db.meta.find_one_and_update(
+            {"_id": "catalog"},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        self.version = max(self.version, int(doc["version"]))
+        self._checked_at = time.monotonic()
+        self._body = None
+        return self.version
+
+    def etag(self, version: int, query_string: str = "") -> str:
+        if not query_string:
+            return f'W/"v{version}"'
+        digest = hashlib.sha1(query_string.encode()).hexdigest()[:12]
+        return f'W/"v{version}-{digest}"'
+
+    @staticmethod
+    def matches(if_none_match: Optional[str], etag: str) -> bool:
+        if not if_none_match:
+            return False
+        tags = [t.strip() for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+
+    def store_body(self, version: int, body: bytes):
+        # Solo guardamos si nadie cambió el catálogo mientras se armaba
+        if version == self.version:
+            self._body = (version, body)
+
+    async def full_body(self, version: int, build) -> bytes:
+        """
+        Cuerpo del catálogo completo para `version`: del cache, o de una única
+        construcción en curso por versión que comparten las peticiones concurrentes.
+        """
+        if self._body and self._body[0] == version:
+            self.body_hits += 1
+            return self._body[1]
+        task = self._building.get(version)
+        if task is None:
+            self.body_misses += 1
+            task = asyncio.ensure_future(build())
+            self._building[version] = task
+            task.add_done_callback(lambda t: self._built(version, t))
+        else:
+            self.body_shared += 1
+        # shield: si un cliente se desconecta, la construcción sigue para los demás
+        return await asyncio.shield(task)
+
+    def _built(self, version: int, task: asyncio.Task):
+        self._building.pop(version, None)
+        if not task.cancelled() and task.exception() is None:
+            self.store_body(version, task.result())
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "not_modified": self.not_modified,
+            "body_hits": self.body_hits,
+            "body_misses": self.body_misses,
+            "body_shared": self.body_shared,
+            "body_building": len(self._building),
+            "body_bytes": len(self._body[1]) if self._body else 0,
+        }
+
+
+catalog = CatalogVersion()
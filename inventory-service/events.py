@@ -0,0 +1,98 @@
+import os
+import json
+import asyncio
+from collections import deque
+from typing import Optional
+
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", "10000"))  # eventos guardados para reanudar
+EVENT_SUBSCRIBER_QUEUE = int(os.getenv("EVENT_SUBSCRIBER_QUEUE", "1000"))
+EVENT_HEARTBEAT = float(os.getenv("EVENT_HEARTBEAT", "15"))  # s
+
+
+class EventHub:
+    """
+    Hub en proceso de cambios de productos/stock.
+    Cada evento lleva un número de secuencia creciente; los últimos
+    EVENT_BUFFER_SIZE se guardan para que un suscriptor pueda reanudar.
+    Un suscriptor que no consume a tiempo se desconecta (y reanuda luego).
+    """
+
+    def __init__(self):
+        self.seq = 0
+        self._buffer: deque = deque(maxlen=EVENT_BUFFER_SIZE)
+        self._subscribers: set = set()
+        self.published = 0
+        self.dropped_subscribers = 0
+
+    def publish(self, event_type: str, data: dict) -> int:
+        self.seq += 1
+        event = (self.seq, event_type, data)
+        self._buffer.append(event)
+        self.published += 1
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Cliente lento: se cierra su stream; puede reanudar desde su último id
+                self._subscribers.discard(queue)
+                self.dropped_subscribers += 1
+        return self.seq
+
+    def backlog(self, since: int) -> Optional[list]:
+        """Eventos con seq > since, o None si ya no están en el buffer."""
+        if since > self.seq:
+            return None  # id de antes de un reinicio del servicio
+        if since == self.seq:
+            return []
+        if not self._buffer or self._buffer[0][0] > since + 1:
+            return None
+        return [e for e in self._buffer if e[0] > since]
+
+    async def subscribe(self, since: Optional[int] = None):
+        """Generador de eventos SSE ya formateados (backlog + en vivo)."""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=EVENT_SUBSCRIBER_QUEUE)
+        self._subscribers.add(queue)
+        try:
+            if since is not None:
+                backlog = self.backlog(since)
+                if backlog is None:
+                    # Se perdieron eventos: el cliente debe recargar el catálogo
+                    yield format_sse(self.seq, "reset", {"reason": "buffer_overflow", "seq": self.seq})
+                    last = self.seq
+                else:
+                    last = since
+                    for event in backlog:
+                        yield format_sse(*event)
+                        last = event[0]
+            else:
+                last = self.seq
+                yield format_sse(self.seq, "hello", {"seq": self.seq})
+
+            while queue in self._subscribers:
+                try:
+                    seq, event_type, data = await asyncio.wait_for(queue.get(), EVENT_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if seq <= last:
+                    continue  # ya enviado en el backlog
+                last = seq
+                yield format_sse(seq, event_type, data)
+        finally:
+            self._subscribers.discard(queue)
+
+    def stats(self) -> dict:
+        return {
+            "seq": self.seq,
+            "published": self.published,
+            "buffered": len(self._buffer),
+            "subscribers": len(self._subscribers),
+            "dropped_subscribers": self.dropped_subscribers,
+        }
+
+
+def format_sse(seq: int, event_type: str, data: dict) -> str:
+    return f"id: {seq}\nevent: {event_type}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+hub = EventHub()
@@ -1,13 +1,36 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pydantic import ValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from bson import ObjectId
+from datetime import datetime, timedelta, timezone
+from typing import Optional
 import os
+import re
+import csv
+import json
+import codecs
+import base64
 import uuid
+import asyncio
 import logging
 
-from models import Product, ReserveRequest, ReservationAction, ProductOut
-from utils import check_low_stock, verify_admin, verify_admin_or_open
+from catalog import catalog
+from events import hub
+from stock_counters import stock_counters, STOCK_FLUSH_INTERVAL
+from models import Product, ProductLookup, ReserveRequest, ReservationAction, ReservationBatchAction, ProductOut
+from utils import (
+    alert_dispatcher_stats,
+    check_low_stock,
+    close_http_client,
+    run_alert_dispatcher,
+    token_cache_stats,
+    verify_admin,
+    verify_admin_or_open,
+)
 
 app = FastAPI(title="Inventory Service")
 logger = logging.getLogger("uvicorn.error")
@@ -21,6 +44,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
 # ========================
@@ -32,9 +56,58 @@ DB_NAME = os.getenv("NAME_DB")
 client: AsyncIOMotorClient = None
 db = None
 
+PRODUCT_FIELDS = ("product_id", "name", "price", "stock", "min_stock")
+MAX_LOOKUP_IDS = int(os.getenv("MAX_LOOKUP_IDS", "1000"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "500"))  # docs por chunk al hacer streaming
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "1000"))  # upserts por bulk_write
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", "1000"))  # errores detallados en la respuesta
+# Requiere replica set (Atlas lo es). Con false, o si al arrancar Mongo resulta ser un
+# mongod suelto, se usa descuento condicional + compensación.
+RESERVE_USE_TRANSACTIONS = os.getenv("RESERVE_USE_TRANSACTIONS", "true").lower() in ("1", "true", "yes")
+
+# Reservas que nadie confirma ni libera vuelven al stock pasado este tiempo
+# (salvo las pedidas con expires=false). Debe superar lo que tarda quien reserva en confirmar.
+RESERVATION_TTL = int(os.getenv("RESERVATION_TTL", "900"))  # s
+RESERVATION_SWEEP_INTERVAL = float(os.getenv("RESERVATION_SWEEP_INTERVAL", "60"))  # s
+RESERVATION_SWEEP_BATCH = int(os.getenv("RESERVATION_SWEEP_BATCH", "500"))
+MAX_BATCH_RESERVATIONS = int(os.getenv("MAX_BATCH_RESERVATIONS", "1000"))  # ids por commit/release en lote
+
+# Eventos SSE desde change streams de Mongo (requiere replica set) en vez de publicarlos en los endpoints
+EVENTS_FROM_CHANGE_STREAM = os.getenv("EVENTS_FROM_CHANGE_STREAM", "false").lower() in ("1", "true", "yes")
+
+background_tasks = []
+use_transactions = False  # RESERVE_USE_TRANSACTIONS y la topología lo permite (ver startup_db)
+
+
+async def ensure_indexes():
+    try:
+        await db.products.create_index("product_id", unique=True, name="uniq_product_id")
+    except Exception as e:
+        # p.ej. ya hay product_id duplicados: el servicio arranca igual, pero avisamos
+        logger.error(f"❌ No se pudo crear el índice único de products.product_id: {e}")
+    try:
+        await db.products.create_index("name", name="name")
+    except Exception as e:
+        logger.error(f"❌ No se pudo crear el índice de products.name: {e}")
+    try:
+        await db.reservations.create_index("reservation_id", unique=True, name="uniq_reservation_id")
+        await db.reservations.create_index([("status", 1), ("expires_at", 1)], name="status_expires_at")
+    except Exception as e:
+        logger.error(f"❌ No se pudieron crear los índices de reservations: {e}")
+
+async def supports_transactions() -> bool:
+    """Transacciones solo en replica set (hello trae setName) o detrás de mongos."""
+    try:
+        hello = await client.admin.command("hello")
+    except Exception as e:
+        logger.error(f"❌ No se pudo consultar la topología de MongoDB: {e}")
+        return False
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
+
 @app.on_event("startup")
 async def startup_db():
-    global client, db
+    global client, db, use_transactions
     try:
         client = AsyncIOMotorClient(MONGO_URL, serverSelectionTimeoutMS=5000)
         # Probar conexión con ping
@@ -44,103 +117,724 @@ async def startup_db():
     except Exception as e:
         logger.error(f"❌ Error conectando a MongoDB Atlas: {e}")
         raise HTTPException(status_code=503, detail="No se pudo conectar a la base de datos")
+    if RESERVE_USE_TRANSACTIONS:
+        use_transactions = await supports_transactions()
+        if not use_transactions:
+            logger.warning("⚠️ MongoDB sin replica set: las reservas usan descuento condicional + compensación")
+    await ensure_indexes()
+    await catalog.load(db)
+    if stock_counters.enabled:
+        await stock_counters.connect()
+        logger.info("✅ Contadores de stock en Redis activos")
+        background_tasks.append(asyncio.create_task(stock_flush_loop()))
+    background_tasks.append(asyncio.create_task(sweep_expired_reservations_loop()))
+    background_tasks.append(asyncio.create_task(run_alert_dispatcher()))
+    if EVENTS_FROM_CHANGE_STREAM:
+        background_tasks.append(asyncio.create_task(watch_product_changes()))
 
 
 @app.on_event("shutdown")
 async def shutdown_db():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if stock_counters.enabled:
+        try:
+            await stock_counters.flush(db, catalog)  # último volcado a Mongo
+        except Exception as e:
+            logger.error(f"❌ Error en el volcado final de stock: {e}")
+        await stock_counters.close()
+    await close_http_client()
     if client:
         client.close()
         logger.info("🔌 Conexión a MongoDB cerrada.")
 
 
+# ========================
+# Helpers
+# ========================
+
+async def find_products_by_ids(product_ids, fields=PRODUCT_FIELDS) -> dict:
+    """
+    Busca varios productos en una sola consulta ($in sobre el índice de product_id).
+    Devuelve {product_id: doc} solo con los campos pedidos.
+    """
+    ids = list(dict.fromkeys(product_ids))
+    if not ids:
+        return {}
+    projection = {f: 1 for f in fields}
+    projection["product_id"] = 1
+    found = {}
+    async for p in db.products.find({"product_id": {"$in": ids}}, projection):
+        found[p["product_id"]] = p
+    return found
+
+
+def parse_fields(fields: Optional[str]) -> tuple:
+    if not fields:
+        return PRODUCT_FIELDS
+    requested = tuple(f.strip() for f in fields.split(",") if f.strip())
+    unknown = set(requested) - set(PRODUCT_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Campos no válidos: {', '.join(sorted(unknown))}")
+    return requested
+
+
+def encode_cursor(product_id: str) -> str:
+    return base64.urlsafe_b64encode(product_id.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        return base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    except Exception:
+        raise HTTPException(status_code=422, detail="Cursor inválido")
+
+
+def to_product_out(p: dict) -> dict:
+    p["id"] = str(p.pop("_id"))
+    return p
+
+
+async def stream_products(query: dict, projection: dict):
+    """Serializa el listado como un arreglo JSON por chunks, sin armarlo en memoria."""
+    yield "["
+    first = True
+    chunk = []
+    async for p in db.products.find(query, projection).sort("product_id", 1).batch_size(STREAM_BATCH_SIZE):
+        chunk.append(json.dumps(to_product_out(p), default=str))
+        if len(chunk) >= STREAM_BATCH_SIZE:
+            yield ("" if first else ",") + ",".join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield ("" if first else ",") + ",".join(chunk)
+    yield "]"
+
+
+async def iter_lines(request: Request):
+    """Líneas del cuerpo a medida que llegan (sin cargar el archivo completo)."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    async for chunk in request.stream():
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+
+async def iter_import_rows(request: Request, fmt: str):
+    """Devuelve (n_fila, dict) por cada fila no vacía de un NDJSON o CSV con cabecera."""
+    header = None
+    row_number = 0
+    async for line in iter_lines(request):
+        if not line.strip():
+            continue
+        if fmt == "csv" and header is None:
+            header = [h.strip() for h in next(csv.reader([line]))]
+            continue
+        row_number += 1
+        if fmt == "csv":
+            values = next(csv.reader([line]))
+            yield row_number, dict(zip(header, values))
+        else:
+            try:
+                yield row_number, json.loads(line)
+            except ValueError:
+                yield row_number, None
+
+
+class ImportReport:
+    def __init__(self):
+        self.processed = 0
+        self.inserted = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, row: int, message: str):
+        self.failed += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({"row": row, "error": message})
+
+    def as_dict(self) -> dict:
+        return {
+            "processed": self.processed,
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "failed": self.failed,
+            "errors": self.errors,
+        }
+
+
+async def flush_import_chunk(chunk: list, report: ImportReport):
+    """Un bulk_write de upserts por product_id; los errores se asignan a su fila."""
+    if not chunk:
+        return
+    ops = [
+        UpdateOne({"product_id": doc["product_id"]}, {"$set": doc}, upsert=True)
+        for _, doc in chunk
+    ]
+    if not stock_counters.enabled:
+        await write_import_chunk(ops, chunk, report)
+        return
+    # El import fija el stock en Mongo: con el lock del volcado tomado (ningún $inc
+    # viejo se aplica encima del $set) y después de escribir, se descartan los
+    # contadores para que se recarguen con el valor importado
+    async with stock_counters.exclusive():
+        try:
+            await write_import_chunk(ops, chunk, report)
+        finally:
+            await stock_counters.forget(doc["product_id"] for _, doc in chunk)
+
+
+async def write_import_chunk(ops: list, chunk: list, report: ImportReport):
+    try:
+        result = await db.products.bulk_write(ops, ordered=False)
+        report.inserted += result.upserted_count
+        report.updated += result.matched_count
+    except BulkWriteError as e:
+        details = e.details
+        report.inserted += details.get("nUpserted", 0)
+        report.updated += details.get("nMatched", 0)
+        for err in details.get("writeErrors", []):
+            report.error(chunk[err["index"]][0], err.get("errmsg", "Error de escritura"))
+
+
+class ReservationConflict(Exception):
+    """Alguna línea no pudo descontarse: la reserva completa se deshace."""
+
+
+def aggregate_quantities(items) -> dict:
+    quantities = {}
+    for item in items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+    return quantities
+
+
+async def reserve_stock_transaction(quantities: dict, reservation_doc: dict):
+    """
+    Un solo bulk_write de $inc condicionados a stock >= cantidad, dentro de
+    una transacción junto con el insert de la reserva: todo o nada.
+    with_transaction reintenta solo ante conflictos transitorios (SKUs calientes).
+    """
+    ops = [
+        UpdateOne({"product_id": pid, "stock": {"$gte": qty}}, {"$inc": {"stock": -qty}})
+        for pid, qty in quantities.items()
+    ]
+
+    async def txn(session):
+        result = await db.products.bulk_write(ops, ordered=False, session=session)
+        if result.modified_count != len(ops):
+            raise ReservationConflict()
+        await db.reservations.insert_one(dict(reservation_doc), session=session)
+
+    async with await client.start_session() as session:
+        await session.with_transaction(txn)
+
+
+async def reserve_stock_compensating(quantities: dict, reservation_doc: dict):
+    """
+    Alternativa sin transacciones: cada descuento es condicional (no hay
+    sobreventa) y si alguno falla se devuelven los ya aplicados.
+    """
+    applied = []
+    try:
+        for pid, qty in quantities.items():
+            result = await db.products.update_one(
+                {"product_id": pid, "stock": {"$gte": qty}},
+                {"$inc": {"stock": -qty}}
+            )
+            if result.modified_count != 1:
+                raise ReservationConflict()
+            applied.append((pid, qty))
+        await db.reservations.insert_one(dict(reservation_doc))
+    except BaseException:
+        if applied:
+            await db.products.bulk_write(
+                [UpdateOne({"product_id": pid}, {"$inc": {"stock": qty}}) for pid, qty in applied],
+                ordered=False
+            )
+        raise
+
+
+async def reserve_stock_redis(quantities: dict, reservation_doc: dict) -> dict:
+    """
+    Descuento atómico en los contadores de Redis (un script para toda la reserva);
+    Mongo solo recibe el insert de la reserva. Si el insert falla se devuelve el stock.
+    """
+    stocks = await stock_counters.reserve(db, quantities)
+    if stocks is None:
+        raise ReservationConflict()
+    try:
+        await db.reservations.insert_one(dict(reservation_doc))
+    except BaseException:
+        await stock_counters.give_back(quantities)
+        raise
+    return stocks
+
+
+async def reservation_error(quantities: dict) -> HTTPException:
+    """Solo en el camino de error: explica por qué no se pudo reservar."""
+    products = await find_products_by_ids(quantities, ("stock",))
+    for pid in quantities:
+        if pid not in products:
+            return HTTPException(status_code=404, detail=f"Producto {pid} no existe")
+    for pid, qty in quantities.items():
+        if products[pid]["stock"] < qty:
+            return HTTPException(status_code=409, detail=f"Stock insuficiente para {pid}")
+    return HTTPException(status_code=409, detail="Stock insuficiente")
+
+
+async def return_stock(reservations):
+    """Devuelve al stock los ítems de varias reservas, agregados por producto (un bulk_write)."""
+    quantities = {}
+    for reservation in reservations:
+        for item in reservation["items"]:
+            quantities[item["product_id"]] = quantities.get(item["product_id"], 0) + item["reserved"]
+    # Con contadores en Redis, a Mongo solo va lo que no tiene contador cargado
+    direct = await stock_counters.give_back(quantities) if stock_counters.enabled else quantities
+    if direct:
+        await db.products.bulk_write(
+            [UpdateOne({"product_id": pid}, {"$inc": {"stock": qty}}) for pid, qty in direct.items()],
+            ordered=False
+        )
+    return quantities
+
+
+async def transition_reservation(reservation_id: str, new_status: str):
+    """
+    Pasa una reserva de 'reserved' a new_status de forma atómica y la devuelve.
+    Así commit, release y el barrido de expiradas nunca actúan dos veces sobre la misma.
+    """
+    return await db.reservations.find_one_and_update(
+        {"reservation_id": reservation_id, "status": "reserved"},
+        {"$set": {"status": new_status, "updated_at": datetime.now(timezone.utc)}},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def transition_reservations(reservation_ids: list, new_status: str) -> list:
+    """
+    Versión en lote de transition_reservation: un update_many de 'reserved' a
+    new_status, marcado con un token propio para saber exactamente cuáles cambió
+    esta operación (un commit/release/barrido concurrente puede ganar alguna).
+    Devuelve las reservas cambiadas (reservation_id + items).
+    """
+    if not reservation_ids:
+        return []
+    transition_id = uuid.uuid4().hex
+    await db.reservations.update_many(
+        {"reservation_id": {"$in": reservation_ids}, "status": "reserved"},
+        {"$set": {"status": new_status, "transition_id": transition_id, "updated_at": datetime.now(timezone.utc)}}
+    )
+    return [r async for r in db.reservations.find(
+        {"reservation_id": {"$in": reservation_ids}, "transition_id": transition_id},
+        {"reservation_id": 1, "items": 1}
+    )]
+
+
+async def batch_results(reservation_ids: list, changed: list, new_status: str) -> list:
+    """Resultado por id, en el orden recibido; los no cambiados se explican con una sola consulta."""
+    changed_ids = {r["reservation_id"] for r in changed}
+    others = [rid for rid in reservation_ids if rid not in changed_ids]
+    current = {}
+    if others:
+        current = {
+            r["reservation_id"]: r["status"]
+            async for r in db.reservations.find({"reservation_id": {"$in": others}}, {"reservation_id": 1, "status": 1})
+        }
+    results = []
+    for rid in reservation_ids:
+        if rid in changed_ids or current.get(rid) == new_status:
+            # Ya estaba en new_status (p.ej. un reintento): se considera éxito
+            results.append({"reservation_id": rid, "ok": True, "status": new_status})
+        elif rid not in current:
+            results.append({"reservation_id": rid, "ok": False, "error": "Reserva no encontrada"})
+        else:
+            results.append({
+                "reservation_id": rid, "ok": False, "status": current[rid],
+                "error": "Reserva no en estado 'reserved'",
+            })
+    return results
+
+
+def check_batch(body: ReservationBatchAction) -> list:
+    ids = list(dict.fromkeys(body.reservation_ids))
+    if len(ids) > MAX_BATCH_RESERVATIONS:
+        raise HTTPException(status_code=422, detail=f"Máximo {MAX_BATCH_RESERVATIONS} reservas por lote")
+    return ids
+
+
+def publish_event(event_type: str, data: dict):
+    """Publica en el hub, salvo que los eventos vengan de los change streams."""
+    if not EVENTS_FROM_CHANGE_STREAM:
+        hub.publish(event_type, data)
+
+
+def publish_stock_deltas(quantities: dict, sign: int, reason: str, stocks: Optional[dict] = None):
+    for pid, qty in quantities.items():
+        data = {"product_id": pid, "delta": sign * qty, "reason": reason}
+        if stocks and pid in stocks:
+            data["stock"] = stocks[pid]
+        publish_event("stock", data)
+
+
+# ========================
+# Tareas en segundo plano
+# ========================
+
+async def watch_product_changes():
+    """Alimenta el hub desde el change stream de products, reanudando tras errores."""
+    resume_token = None
+    while True:
+        try:
+            async with db.products.watch(full_document="updateLookup", resume_after=resume_token) as stream:
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    doc = change.get("fullDocument")
+                    if change["operationType"] == "delete" or not doc:
+                        continue
+                    hub.publish("product", to_product_out(doc))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Change stream de products interrumpido: {e}")
+            await asyncio.sleep(5)
+
+async def sweep_expired_reservations() -> int:
+    """
+    Libera en lotes las reservas 'reserved' cuyo expires_at ya pasó. Las que
+    no tienen expires_at (pedidas con expires=false o anteriores) no vencen.
+    """
+    now = datetime.now(timezone.utc)
+    released = 0
+    while True:
+        ids = [
+            r["reservation_id"]
+            async for r in db.reservations.find(
+                {"status": "reserved", "expires_at": {"$lt": now}},
+                {"reservation_id": 1}
+            ).sort("expires_at", 1).limit(RESERVATION_SWEEP_BATCH)
+        ]
+        if not ids:
+            return released
+
+        expired = await transition_reservations(ids, "expired")
+        returned = await return_stock(expired)
+        if expired:
+            await catalog.bump(db)
+            publish_stock_deltas(returned, +1, "expire")
+        released += len(expired)
+        if len(ids) < RESERVATION_SWEEP_BATCH:
+            return released
+
+
+async def sweep_expired_reservations_loop():
+    while True:
+        await asyncio.sleep(RESERVATION_SWEEP_INTERVAL)
+        try:
+            released = await sweep_expired_reservations()
+            if released:
+                logger.info(f"♻️ Reservas expiradas liberadas: {released}")
+        except Exception as e:
+            logger.error(f"❌ Error liberando reservas expiradas: {e}")
+
+
+async def stock_flush_loop():
+    while True:
+        await asyncio.sleep(STOCK_FLUSH_INTERVAL)
+        try:
+            await stock_counters.flush(db, catalog)
+        except Exception as e:
+            logger.error(f"❌ Error volcando stock de Redis a Mongo: {e}")
+
+
 # ========================
 # Endpoints
 # ========================
 
 @app.post("/inventory/products", response_model=ProductOut, status_code=201)
 async def create_product(product: Product, user=Depends(verify_admin)):
-    if await db.products.find_one({"product_id": product.product_id}):
+    product_doc = product.dict()
+    try:
+        # El índice único de product_id resuelve los duplicados (también entre requests concurrentes)
+        await db.products.insert_one(product_doc)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Producto ya existe")
+    await catalog.bump(db)
+
+    product_out = to_product_out(product_doc)
+    publish_event("product", product_out)
+    return product_out
 
-    product_doc = product.dict()
-    result = await db.products.insert_one(product_doc)
 
-    return {"id": str(result.inserted_id), **product_doc}
 
 
+@app.post("/inventory/products/import")
+async def import_products(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$", description="Por defecto según Content-Type"),
+    user=Depends(verify_admin),
+):
+    """
+    Carga masiva (upsert por product_id) desde NDJSON o CSV con cabecera
+    product_id,name,price,stock,min_stock. El cuerpo se procesa en streaming
+    y se escribe con bulk_write por lotes de IMPORT_CHUNK_SIZE.
+    """
+    fmt = format
+    if fmt is None:
+        content_type = request.headers.get("content-type", "")
+        fmt = "csv" if "csv" in content_type else "ndjson"
+
+    report = ImportReport()
+    chunk = []
+    seen_in_chunk = set()
+    async for row_number, raw in iter_import_rows(request, fmt):
+        report.processed += 1
+        if not isinstance(raw, dict):
+            report.error(row_number, "Fila no es un objeto JSON válido")
+            continue
+        try:
+            product = Product(**raw)
+        except ValidationError as e:
+            report.error(row_number, "; ".join(
+                f"{'.'.join(str(loc) for loc in err['loc'])}: {err['msg']}" for err in e.errors()
+            ))
+            continue
+
+        # Un mismo product_id dos veces en el lote: se escribe el anterior primero
+        if product.product_id in seen_in_chunk:
+            await flush_import_chunk(chunk, report)
+            chunk, seen_in_chunk = [], set()
+        chunk.append((row_number, product.dict()))
+        seen_in_chunk.add(product.product_id)
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            await flush_import_chunk(chunk, report)
+            chunk, seen_in_chunk = [], set()
+    await flush_import_chunk(chunk, report)
+
+    if report.inserted or report.updated:
+        await catalog.bump(db)
+        # Importación masiva: un solo aviso para que los clientes recarguen
+        publish_event("catalog", {"reason": "import", "inserted": report.inserted, "updated": report.updated})
+    return report.as_dict()
+
+
+@app.get("/inventory/stream")
+async def stock_stream(
+    since: Optional[int] = Query(None, ge=0, description="Último id recibido (alternativa a Last-Event-ID)"),
+    last_event_id: Optional[str] = Header(None),
+):
+    """
+    Server-sent events con cambios de productos ('product'), deltas de stock
+    ('stock') y recargas masivas ('catalog'). Para reanudar se envía el último
+    id recibido; si ya no está en el buffer llega un evento 'reset'.
+    Los ids son por instancia del servicio.
+    """
+    if since is None and last_event_id:
+        try:
+            since = int(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=422, detail="Last-Event-ID inválido")
+    return StreamingResponse(
+        hub.subscribe(since),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/inventory/metrics")
+async def metrics():
+    return {
+        "events": hub.stats(),
+        "catalog": catalog.stats(),
+        "auth": token_cache_stats(),
+        "alerts": alert_dispatcher_stats(),
+        "stock_counters": stock_counters.stats(),
+    }
 
 
 @app.get("/inventory/products")
-async def list_products():
-    cursor = db.products.find()
+async def list_products(
+    request: Request,
+    if_none_match: Optional[str] = Header(None),
+    limit: Optional[int] = Query(None, ge=1, description="Tamaño de página (sin limit: catálogo completo en streaming)"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor de la página anterior"),
+    q: Optional[str] = Query(None, min_length=1, description="Prefijo de nombre o product_id"),
+    low_stock: bool = Query(False, description="Solo productos con stock < min_stock"),
+    fields: Optional[str] = Query(None, description="Campos separados por coma"),
+):
+    """
+    Orden por product_id (índice único), paginación por llave con cursor opaco.
+    El cuerpo siempre es una lista; si hay más páginas se envía X-Next-Cursor.
+    ETag = versión del catálogo (+ parámetros): If-None-Match responde 304 sin ir a Mongo.
+    """
+    version = await catalog.current(db)
+    etag = catalog.etag(version, request.url.query)
+    if catalog.matches(if_none_match, etag):
+        catalog.not_modified += 1
+        return Response(status_code=304, headers={"ETag": etag})
+
+    projection = {f: 1 for f in parse_fields(fields)}
+    projection["product_id"] = 1
+
+    query: dict = {}
+    if q:
+        prefix = "^" + re.escape(q)
+        # regex anclada y sensible a mayúsculas: se resuelve con los índices de name/product_id
+        query["$or"] = [{"name": {"$regex": prefix}}, {"product_id": {"$regex": prefix}}]
+    if low_stock:
+        query["$expr"] = {"$lt": ["$stock", "$min_stock"]}
+    if cursor:
+        query["product_id"] = {"$gt": decode_cursor(cursor)}
+
+    if not request.url.query:
+        # Catálogo completo: un solo cuerpo serializado por versión, armado una vez
+        async def build() -> bytes:
+            return "".join([chunk async for chunk in stream_products(query, projection)]).encode()
+
+        body = await catalog.full_body(version, build)
+        return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+    if limit is None:
+        return StreamingResponse(
+            stream_products(query, projection), media_type="application/json", headers={"ETag": etag}
+        )
+
+    limit = min(limit, MAX_PAGE_SIZE)
+    products = [
+        to_product_out(p)
+        async for p in db.products.find(query, projection).sort("product_id", 1).limit(limit + 1)
+    ]
+    headers = {"ETag": etag}
+    if len(products) > limit:
+        products = products[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(products[-1]["product_id"])
+    return JSONResponse(products, headers=headers)
+
+
+@app.post("/inventory/products/lookup")
+async def lookup_products(body: ProductLookup):
+    """
+    Devuelve solo los productos pedidos (en el orden recibido; los que no
+    existen se omiten). Para billing/frontend: O(items) en vez de O(catálogo).
+    """
+    if len(body.product_ids) > MAX_LOOKUP_IDS:
+        raise HTTPException(status_code=422, detail=f"Máximo {MAX_LOOKUP_IDS} product_ids por consulta")
+
+    fields = PRODUCT_FIELDS
+    if body.fields:
+        unknown = set(body.fields) - set(PRODUCT_FIELDS)
+        if unknown:
+            raise HTTPException(status_code=422, detail=f"Campos no válidos: {', '.join(sorted(unknown))}")
+        fields = tuple(body.fields)
+
+    found = await find_products_by_ids(body.product_ids, fields)
     products = []
-    async for p in cursor:
-        p["id"] = str(p["_id"])
-        del p["_id"]
-        products.append(p)
+    for pid in dict.fromkeys(body.product_ids):
+        p = found.get(pid)
+        if p is None:
+            continue
+        products.append(to_product_out(p))
     return products
 
 
 @app.post("/inventory/reserve")
 async def reserve_items(req: ReserveRequest, user=Depends(verify_admin_or_open)):
-    reservation_id = f"res-{uuid.uuid4().hex[:6]}"
-    reservation_items = []
-
-    for item in req.items:
-        product = await db.products.find_one({"product_id": item.product_id})
-        if not product:
-            raise HTTPException(status_code=404, detail=f"Producto {item.product_id} no existe")
-        if product["stock"] < item.quantity:
-            raise HTTPException(status_code=409, detail=f"Stock insuficiente para {item.product_id}")
-        reservation_items.append({"product_id": item.product_id, "reserved": item.quantity})
-    
-    for item in reservation_items:
-        await db.products.update_one(
-            {"product_id": item["product_id"]},
-            {"$inc": {"stock": -item["reserved"]}}
-        )
-        updated = await db.products.find_one({"product_id": item["product_id"]})
-        await check_low_stock(updated)
+    reservation_id = req.reservation_id or f"res-{uuid.uuid4().hex}"
+    reservation_items = [{"product_id": item.product_id, "reserved": item.quantity} for item in req.items]
+    if any(item["reserved"] <= 0 for item in reservation_items):
+        raise HTTPException(status_code=422, detail="Las cantidades deben ser mayores que 0")
 
-    await db.reservations.insert_one({
+    quantities = aggregate_quantities(req.items)
+    created_at = datetime.now(timezone.utc)
+    reservation_doc = {
         "reservation_id": reservation_id,
         "items": reservation_items,
-        "status": "reserved"
-    })
+        "status": "reserved",
+        "created_at": created_at,
+        "expires_at": created_at + timedelta(seconds=RESERVATION_TTL) if req.expires else None,
+    }
+    if stock_counters.enabled:
+        reserve = reserve_stock_redis
+    else:
+        reserve = reserve_stock_transaction if use_transactions else reserve_stock_compensating
+    try:
+        stocks = await reserve(quantities, reservation_doc)
+    except ReservationConflict:
+        raise await reservation_error(quantities)
+    except DuplicateKeyError:
+        # El stock ya se devolvió; si es un reintento del mismo cliente respondemos con la reserva existente
+        existing = await db.reservations.find_one({"reservation_id": reservation_id}, {"_id": 0, "items": 1})
+        if not req.reservation_id or not existing:
+            raise
+        return {"reservation_id": reservation_id, "items": existing["items"]}
+
+    updated = await find_products_by_ids(quantities, ("name", "stock", "min_stock"))
+    if stocks:
+        # Mongo aún no tiene el descuento: el stock real está en Redis
+        # (la versión del catálogo sube cuando se vuelca)
+        for pid, product in updated.items():
+            product["stock"] = stocks[pid]
+    else:
+        await catalog.bump(db)
+    publish_stock_deltas(quantities, -1, "reserve", {pid: p["stock"] for pid, p in updated.items()})
+    for product in updated.values():
+        await check_low_stock(product)
+
     return {"reservation_id": reservation_id, "items": reservation_items}
 
 
 @app.post("/inventory/commit")
 async def commit_reservation(action: ReservationAction, user=Depends(verify_admin_or_open)):
-    reservation = await db.reservations.find_one({"reservation_id": action.reservation_id})
+    reservation = await transition_reservation(action.reservation_id, "committed")
     if not reservation:
-        raise HTTPException(status_code=404, detail="Reserva no encontrada")
-    if reservation["status"] != "reserved":
-        raise HTTPException(status_code=400, detail="Reserva no en estado 'reserved'")
-    
-    await db.reservations.update_one(
-        {"reservation_id": action.reservation_id},
-        {"$set": {"status": "committed"}}
-    )
+        current = await db.reservations.find_one({"reservation_id": action.reservation_id}, {"status": 1})
+        if not current:
+            raise HTTPException(status_code=404, detail="Reserva no encontrada")
+        # Idempotente: billing reintenta el commit si no recibió la respuesta
+        if current["status"] != "committed":
+            raise HTTPException(status_code=400, detail="Reserva no en estado 'reserved'")
     return {"status": "committed"}
 
 
 @app.post("/inventory/release")
 async def release_reservation(action: ReservationAction, user=Depends(verify_admin_or_open)):
-    reservation = await db.reservations.find_one({"reservation_id": action.reservation_id})
+    reservation = await transition_reservation(action.reservation_id, "released")
     if not reservation:
-        raise HTTPException(status_code=404, detail="Reserva no encontrada")
-    if reservation["status"] != "reserved":
+        if not await db.reservations.find_one({"reservation_id": action.reservation_id}, {"_id": 1}):
+            raise HTTPException(status_code=404, detail="Reserva no encontrada")
         raise HTTPException(status_code=400, detail="Solo reservas 'reserved' se pueden liberar")
 
-    for item in reservation["items"]:
-        await db.products.update_one(
-            {"product_id": item["product_id"]},
-            {"$inc": {"stock": item["reserved"]}}
-        )
-    
-    await db.reservations.update_one(
-        {"reservation_id": action.reservation_id},
-        {"$set": {"status": "released"}}
-    )
+    returned = await return_stock([reservation])
+    await catalog.bump(db)
+    publish_stock_deltas(returned, +1, "release")
     return {"status": "released"}
+
+
+@app.post("/inventory/commit/batch")
+async def commit_reservations(body: ReservationBatchAction, user=Depends(verify_admin_or_open)):
+    """Confirma varias reservas con un update_many; resultado por id."""
+    ids = check_batch(body)
+    changed = await transition_reservations(ids, "committed")
+    return {"committed": len(changed), "results": await batch_results(ids, changed, "committed")}
+
+
+@app.post("/inventory/release/batch")
+async def release_reservations(body: ReservationBatchAction, user=Depends(verify_admin_or_open)):
+    """
+    Libera varias reservas con un update_many y devuelve el stock agregado
+    por producto en un solo bulk_write; resultado por id.
+    """
+    ids = check_batch(body)
+    changed = await transition_reservations(ids, "released")
+    if changed:
+        returned = await return_stock(changed)
+        await catalog.bump(db)
+        publish_stock_deltas(returned, +1, "release")
+    return {"released": len(changed), "results": await batch_results(ids, changed, "released")}
@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import List
+from pydantic import BaseModel, Field
+from typing import List, Optional
 
 class Product(BaseModel):
     product_id: str
@@ -16,13 +16,23 @@ class ProductOut(BaseModel):
     stock: int
     min_stock: int
 
+class ProductLookup(BaseModel):
+    product_ids: List[str]
+    fields: Optional[List[str]] = None  # None -> todos los campos de ProductOut
+
 class ReserveItem(BaseModel):
     product_id: str
     quantity: int
 
 class ReserveRequest(BaseModel):
     request_id: str
-    items: List[ReserveItem]
+    items: List[ReserveItem] = Field(..., min_length=1)
+    expires: bool = True  # False: no vence por RESERVATION_TTL (quien reserva no confirma)
+    # Id elegido por quien reserva (lo registra antes de llamar); reintentar con el mismo id no reserva dos veces
+    reservation_id: Optional[str] = None
 
 class ReservationAction(BaseModel):
     reservation_id: str
+
+class ReservationBatchAction(BaseModel):
+    reservation_ids: List[str]
@@ -0,0 +1,289 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+import contextlib
+from typing import Optional
+
+import redis.asyncio as redis
+from pymongo import UpdateOne
+
+logger = logging.getLogger("uvicorn.error")
+
+# Contadores de stock en Redis para el camino caliente de /inventory/reserve.
+# Mongo se actualiza en segundo plano (write-behind); mientras esté activo, el
+# stock solo debe modificarse a través del servicio (reservas, release, import).
+STOCK_COUNTERS_IN_REDIS = os.getenv("STOCK_COUNTERS_IN_REDIS", "false").lower() in ("1", "true", "yes")
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+STOCK_KEY_PREFIX = os.getenv("STOCK_KEY_PREFIX", "inventory:stock:")
+STOCK_FLUSH_INTERVAL = float(os.getenv("STOCK_FLUSH_INTERVAL", "1"))  # s
+STOCK_RECONCILE_INTERVAL = float(os.getenv("STOCK_RECONCILE_INTERVAL", "300"))  # s
+STOCK_RECONCILE_BATCH = int(os.getenv("STOCK_RECONCILE_BATCH", "500"))
+
+PENDING_KEY = STOCK_KEY_PREFIX + "_pending"     # hash product_id -> delta aún no escrito en Mongo
+FLUSHING_KEY = STOCK_KEY_PREFIX + "_flushing"   # delta tomado por el volcado en curso
+LOCK_KEY = STOCK_KEY_PREFIX + "_lock"           # un solo volcado/reconciliación a la vez entre réplicas
+
+# KEYS[1] = pendientes, KEYS[2..] = contadores; ARGV = product_id, cantidad, ...
+# Devuelve {1, stock...} si reservó todo, {0, i} si el ítem i no alcanza,
+# {-1, i...} si hay contadores que aún no están cargados.
+RESERVE_SCRIPT = """
+local n = #ARGV / 2
+local missing = {}
+for i = 1, n do
+  if redis.call('EXISTS', KEYS[i + 1]) == 0 then missing[#missing + 1] = i end
+end
+if #missing > 0 then return {-1, unpack(missing)} end
+for i = 1, n do
+  if tonumber(redis.call('GET', KEYS[i + 1])) < tonumber(ARGV[2 * i]) then return {0, i} end
+end
+local result = {1}
+for i = 1, n do
+  result[#result + 1] = redis.call('DECRBY', KEYS[i + 1], ARGV[2 * i])
+  redis.call('HINCRBY', KEYS[1], ARGV[2 * i - 1], -tonumber(ARGV[2 * i]))
+end
+return result
+"""
+
+# Devuelve cantidades a los contadores cargados; responde los índices sin contador
+# (esos se aplican directo en Mongo).
+RETURN_SCRIPT = """
+local missing = {}
+for i = 1, #ARGV / 2 do
+  if redis.call('EXISTS', KEYS[i + 1]) == 1 then
+    redis.call('INCRBY', KEYS[i + 1], ARGV[2 * i])
+    redis.call('HINCRBY', KEYS[1], ARGV[2 * i - 1], ARGV[2 * i])
+  else
+    missing[#missing + 1] = i
+  end
+end
+return missing
+"""
+
+# Carga contadores desde Mongo sin pisar los existentes; suma lo pendiente de volcar.
+LOAD_SCRIPT = """
+for i = 1, #ARGV / 2 do
+  if redis.call('EXISTS', KEYS[i + 1]) == 0 then
+    local pending = tonumber(redis.call('HGET', KEYS[1], ARGV[2 * i - 1]) or '0')
+    redis.call('SET', KEYS[i + 1], tonumber(ARGV[2 * i]) + pending)
+  end
+end
+return 1
+"""
+
+# Mueve los pendientes al hash del volcado (acumulando si quedó uno sin terminar).
+TAKE_PENDING_SCRIPT = """
+local data = redis.call('HGETALL', KEYS[1])
+for i = 1, #data, 2 do redis.call('HINCRBY', KEYS[2], data[i], data[i + 1]) end
+redis.call('DEL', KEYS[1])
+return redis.call('HGETALL', KEYS[2])
+"""
+
+# Stock que Mongo debería tener: contador - pendiente (atómico frente a las reservas).
+SNAPSHOT_SCRIPT = """
+local result = {}
+for i = 1, #ARGV do
+  local stock = redis.call('GET', KEYS[i + 1])
+  if stock then
+    result[i] = tonumber(stock) - tonumber(redis.call('HGET', KEYS[1], ARGV[i]) or '0')
+  else
+    result[i] = false
+  end
+end
+return result
+"""
+
+# KEYS[1] = pendientes, KEYS[2] = volcado, KEYS[3..] = contadores
+FORGET_SCRIPT = """
+for i = 1, #ARGV do
+  redis.call('DEL', KEYS[i + 2])
+  redis.call('HDEL', KEYS[1], ARGV[i])
+  redis.call('HDEL', KEYS[2], ARGV[i])
+end
+return #ARGV
+"""
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+
+class StockCounters:
+    """
+    Stock disponible por producto en Redis. Una reserva completa se verifica y
+    descuenta en un solo script (todo o nada); los deltas se acumulan en un hash
+    y se vuelcan a products con un bulk_write cada STOCK_FLUSH_INTERVAL.
+    La reconciliación periódica corrige en Mongo cualquier diferencia
+    (p.ej. un volcado repetido tras una caída).
+    """
+
+    def __init__(self):
+        self.enabled = STOCK_COUNTERS_IN_REDIS
+        self.redis: Optional[redis.Redis] = None
+        self._last_reconcile = 0.0
+        self.stats_counters = {
+            "reserved": 0, "conflicts": 0, "loaded": 0, "flushes": 0,
+            "flushed_products": 0, "reconciled": 0, "drift_fixed": 0,
+        }
+
+    async def connect(self):
+        self.redis = redis.from_url(REDIS_URL, decode_responses=True)
+        await self.redis.ping()
+        self._reserve = self.redis.register_script(RESERVE_SCRIPT)
+        self._return = self.redis.register_script(RETURN_SCRIPT)
+        self._load = self.redis.register_script(LOAD_SCRIPT)
+        self._take_pending = self.redis.register_script(TAKE_PENDING_SCRIPT)
+        self._snapshot = self.redis.register_script(SNAPSHOT_SCRIPT)
+        self._forget = self.redis.register_script(FORGET_SCRIPT)
+        self._release_lock = self.redis.register_script(RELEASE_LOCK_SCRIPT)
+
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.aclose()
+            self.redis = None
+
+    @staticmethod
+    def _keys(product_ids) -> list:
+        return [PENDING_KEY] + [STOCK_KEY_PREFIX + pid for pid in product_ids]
+
+    @staticmethod
+    def _args(quantities: dict) -> list:
+        return [v for pid, qty in quantities.items() for v in (pid, qty)]
+
+    async def load(self, db, product_ids) -> set:
+        """Carga los contadores desde Mongo; devuelve los product_id que no existen."""
+        stocks = {
+            p["product_id"]: p["stock"]
+            async for p in db.products.find({"product_id": {"$in": list(product_ids)}}, {"product_id": 1, "stock": 1})
+        }
+        if stocks:
+            await self._load(keys=self._keys(stocks), args=self._args(stocks))
+            self.stats_counters["loaded"] += len(stocks)
+        return set(product_ids) - set(stocks)
+
+    async def reserve(self, db, quantities: dict) -> Optional[dict]:
+        """Descuenta todo o nada. Devuelve {product_id: stock restante} o None si no alcanza."""
+        pids = list(quantities)
+        for _ in range(2):
+            result = await self._reserve(keys=self._keys(pids), args=self._args(quantities))
+            status, rest = int(result[0]), result[1:]
+            if status == 1:
+                self.stats_counters["reserved"] += 1
+                return {pid: int(stock) for pid, stock in zip(pids, rest)}
+            if status == 0:
+                break
+            # Primer uso de estos productos: se cargan y se reintenta una vez
+            if await self.load(db, [pids[int(i) - 1] for i in rest]):
+                break
+        self.stats_counters["conflicts"] += 1
+        return None
+
+    async def give_back(self, quantities: dict) -> dict:
+        """Devuelve stock a los contadores; responde lo que no tenía contador (va directo a Mongo)."""
+        if not quantities:
+            return {}
+        pids = list(quantities)
+        missing = await self._return(keys=self._keys(pids), args=self._args(quantities))
+        return {pids[int(i) - 1]: quantities[pids[int(i) - 1]] for i in missing}
+
+    async def forget(self, product_ids):
+        """
+        Descarta contadores y sus deltas sin volcar (tras un import que fija el
+        stock en Mongo). Llamar con exclusive() tomado, después de escribir en Mongo.
+        """
+        pids = list(product_ids)
+        if pids:
+            keys = [PENDING_KEY, FLUSHING_KEY] + [STOCK_KEY_PREFIX + pid for pid in pids]
+            await self._forget(keys=keys, args=pids)
+
+    @staticmethod
+    def _lock_ms() -> int:
+        return int(max(STOCK_FLUSH_INTERVAL, 1) * 30_000)
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        """Toma el lock del volcado, esperando al que esté en curso (ninguna réplica vuelca mientras tanto)."""
+        token = uuid.uuid4().hex
+        while not await self.redis.set(LOCK_KEY, token, nx=True, px=self._lock_ms()):
+            await asyncio.sleep(0.05)
+        try:
+            yield
+        finally:
+            await self._release_lock(keys=[LOCK_KEY], args=[token])
+
+    async def flush(self, db, catalog) -> int:
+        """Vuelca los deltas pendientes a Mongo y reconcilia si toca. Devuelve productos actualizados."""
+        token = uuid.uuid4().hex
+        if not await self.redis.set(LOCK_KEY, token, nx=True, px=self._lock_ms()):
+            return 0  # otra réplica está volcando
+        try:
+            data = await self._take_pending(keys=[PENDING_KEY, FLUSHING_KEY])
+            deltas = {pid: int(delta) for pid, delta in zip(data[::2], data[1::2]) if int(delta)}
+            if deltas:
+                await db.products.bulk_write(
+                    [UpdateOne({"product_id": pid}, {"$inc": {"stock": d}}) for pid, d in deltas.items()],
+                    ordered=False,
+                )
+                self.stats_counters["flushes"] += 1
+                self.stats_counters["flushed_products"] += len(deltas)
+            await self.redis.delete(FLUSHING_KEY)
+            if deltas:
+                await catalog.bump(db)
+
+            if time.monotonic() - self._last_reconcile >= STOCK_RECONCILE_INTERVAL:
+                self._last_reconcile = time.monotonic()
+                fixed = await self.reconcile(db)
+                if fixed:
+                    await catalog.bump(db)
+            return len(deltas)
+        finally:
+            await self._release_lock(keys=[LOCK_KEY], args=[token])
+
+    async def reconcile(self, db) -> int:
+        """
+        Compara Mongo con contador - pendiente para todos los contadores cargados
+        y corrige Mongo (Redis es la referencia mientras esté activo).
+        Se llama con el lock tomado y sin volcado en curso.
+        """
+        fixed = 0
+        batch = []
+        async for key in self.redis.scan_iter(match=STOCK_KEY_PREFIX + "*", count=STOCK_RECONCILE_BATCH):
+            if key in (PENDING_KEY, FLUSHING_KEY, LOCK_KEY):
+                continue
+            batch.append(key[len(STOCK_KEY_PREFIX):])
+            if len(batch) >= STOCK_RECONCILE_BATCH:
+                fixed += await self._reconcile_batch(db, batch)
+                batch = []
+        if batch:
+            fixed += await self._reconcile_batch(db, batch)
+        return fixed
+
+    async def _reconcile_batch(self, db, pids: list) -> int:
+        expected = await self._snapshot(keys=self._keys(pids), args=pids)
+        mongo = {
+            p["product_id"]: p["stock"]
+            async for p in db.products.find({"product_id": {"$in": pids}}, {"product_id": 1, "stock": 1})
+        }
+        # Productos borrados en Mongo: su contador ya no sirve
+        await self.forget([pid for pid in pids if pid not in mongo])
+        ops = [
+            # Condicionado al valor leído: si Mongo cambió entretanto, se corrige en la próxima vuelta
+            UpdateOne({"product_id": pid, "stock": mongo[pid]}, {"$set": {"stock": int(stock)}})
+            for pid, stock in zip(pids, expected)
+            if pid in mongo and stock is not None and int(stock) != mongo[pid]
+        ]
+        self.stats_counters["reconciled"] += len(pids)
+        if not ops:
+            return 0
+        result = await db.products.bulk_write(ops, ordered=False)
+        self.stats_counters["drift_fixed"] += result.modified_count
+        logger.warning(f"⚠️ Reconciliación de stock: {result.modified_count} producto(s) corregidos en Mongo")
+        return result.modified_count
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, **self.stats_counters}
+
+
+stock_counters = StockCounters()
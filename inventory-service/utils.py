@@ -1,5 +1,12 @@
 import os
+import json
+import asyncio
+import time
+import base64
+import hashlib
 import httpx
+import jwt
+from collections import OrderedDict
 from fastapi import HTTPException, Header
 from typing import Optional
 
@@ -20,22 +27,162 @@ ALLOW_S2S_OPEN = os.getenv("ALLOW_S2S_OPEN", "false").lower() in ("1", "true", "
 
 HTTPX_TIMEOUT = 5.0  # s
 
-async def verify_admin(authorization: Optional[str] = Header(default=None)):
+# Cache de verificación de tokens (clave: sha256 del token; nunca más allá de su exp)
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "60"))  # s
+TOKEN_CACHE_MAX_SIZE = int(os.getenv("TOKEN_CACHE_MAX_SIZE", "10000"))
+# Verificación local sin llamar a /auth/me: tokens RS256/EdDSA con las claves públicas
+# del JWKS de auth-service, o HS256 con la misma SECRET_KEY
+AUTH_LOCAL_VERIFY = os.getenv("AUTH_LOCAL_VERIFY", "false").lower() in ("1", "true", "yes")
+AUTH_JWT_SECRET = os.getenv("AUTH_JWT_SECRET") or os.getenv("SECRET_KEY")
+AUTH_JWKS_URL = os.getenv("AUTH_JWKS_URL", f"{AUTH_SERVICE_URL}/auth/.well-known/jwks.json")
+AUTH_JWKS_TTL = float(os.getenv("AUTH_JWKS_TTL", "300"))  # s
+AUTH_JWKS_MIN_REFRESH = float(os.getenv("AUTH_JWKS_MIN_REFRESH", "30"))  # s entre recargas por kid desconocido
+ASYMMETRIC_ALGORITHMS = ("RS256", "EdDSA")
+
+# Alertas de stock bajo: cola en proceso, agrupadas por product_id dentro de la ventana
+ALERT_COALESCE_WINDOW = float(os.getenv("ALERT_COALESCE_WINDOW", "5"))  # s
+ALERT_QUEUE_MAX = int(os.getenv("ALERT_QUEUE_MAX", "10000"))
+
+_http_client: Optional[httpx.AsyncClient] = None
+_alert_queue: "asyncio.Queue[dict]" = asyncio.Queue(maxsize=ALERT_QUEUE_MAX)
+alert_stats = {"enqueued": 0, "coalesced": 0, "dropped": 0, "sent": 0, "batches": 0, "failed": 0}
+_token_cache: "OrderedDict[str, tuple[dict, float]]" = OrderedDict()
+auth_stats = {"cache_hits": 0, "cache_misses": 0, "local_verified": 0, "remote_verified": 0, "jwks_fetches": 0}
+_jwks: dict = {"keys": {}, "fetched_at": 0.0, "attempted_at": float("-inf")}
+_jwks_lock = asyncio.Lock()
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Cliente HTTP compartido (keep-alive) para auth-service y notifications."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=HTTPX_TIMEOUT)
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def _token_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _token_exp(token: str) -> Optional[float]:
+    """Lee `exp` del payload sin verificar firma (solo para acotar el cache)."""
+    try:
+        payload_b64 = token.split(".")[1]
+        payload = json.loads(base64.urlsafe_b64decode(payload_b64 + "=" * (-len(payload_b64) % 4)))
+        return float(payload["exp"])
+    except Exception:
+        return None
+
+
+def _cache_get(token: str) -> Optional[dict]:
+    key = _token_key(token)
+    entry = _token_cache.get(key)
+    if entry is None:
+        auth_stats["cache_misses"] += 1
+        return None
+    user, expires_at = entry
+    if expires_at <= time.time():
+        del _token_cache[key]
+        auth_stats["cache_misses"] += 1
+        return None
+    _token_cache.move_to_end(key)
+    auth_stats["cache_hits"] += 1
+    return user
+
+
+def _cache_put(token: str, user: dict):
+    expires_at = time.time() + TOKEN_CACHE_TTL
+    exp = _token_exp(token)
+    if exp is not None:
+        expires_at = min(expires_at, exp)
+    if expires_at <= time.time():
+        return
+    key = _token_key(token)
+    _token_cache[key] = (user, expires_at)
+    _token_cache.move_to_end(key)
+    while len(_token_cache) > TOKEN_CACHE_MAX_SIZE:
+        _token_cache.popitem(last=False)
+
+
+def token_cache_stats() -> dict:
+    return {**auth_stats, "size": len(_token_cache), "local_verify": AUTH_LOCAL_VERIFY}
+
+
+async def _fetch_jwks():
+    res = await get_http_client().get(AUTH_JWKS_URL)
+    res.raise_for_status()
+    keys = {}
+    for jwk in res.json().get("keys", []):
+        try:
+            keys[jwk["kid"]] = jwt.PyJWK(jwk)
+        except (KeyError, jwt.PyJWTError):
+            continue
+    _jwks["keys"] = keys
+    _jwks["fetched_at"] = time.monotonic()
+    auth_stats["jwks_fetches"] += 1
+
+
+async def _get_public_key(kid: Optional[str]) -> Optional[jwt.PyJWK]:
     """
-    Exige Authorization: Bearer <JWT> y valida contra auth-service /auth/me.
-    Debe tener rol admin.
+    Clave pública por kid desde el JWKS cacheado (AUTH_JWKS_TTL). Un kid
+    desconocido (rotación) fuerza una recarga; los intentos se limitan a uno
+    cada AUTH_JWKS_MIN_REFRESH. Si auth-service no responde se usan las claves que ya hay.
     """
-    if not authorization or not authorization.startswith("Bearer "):
+    jwk = _jwks["keys"].get(kid)
+    if jwk is not None and time.monotonic() - _jwks["fetched_at"] < AUTH_JWKS_TTL:
+        return jwk
+    async with _jwks_lock:
+        if time.monotonic() - _jwks["attempted_at"] >= AUTH_JWKS_MIN_REFRESH:
+            _jwks["attempted_at"] = time.monotonic()
+            try:
+                await _fetch_jwks()
+            except (httpx.HTTPError, ValueError):
+                pass
+    return _jwks["keys"].get(kid)
+
+
+async def _verify_locally(token: str) -> Optional[dict]:
+    """Verifica el JWT sin ir a auth-service; None si no hay clave con qué hacerlo."""
+    try:
+        header = jwt.get_unverified_header(token)
+    except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Token inválido")
+    alg = header.get("alg")
+    if alg in ASYMMETRIC_ALGORITHMS:
+        jwk = await _get_public_key(header.get("kid"))
+        if jwk is None:
+            return None
+        key = jwk.key
+    elif alg == "HS256" and AUTH_JWT_SECRET:
+        key = AUTH_JWT_SECRET
+    else:
+        return None
 
-    token = authorization.split(" ", 1)[1]
+    try:
+        payload = jwt.decode(token, key, algorithms=[alg], options={"require": ["exp", "iat"]})
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expirado")
+    except jwt.PyJWTError:
+        raise HTTPException(status_code=401, detail="Token inválido")
+    if not payload.get("id"):
+        raise HTTPException(status_code=401, detail="Token inválido")
+    auth_stats["local_verified"] += 1
+    return {"id": payload["id"], "role": payload.get("role"), "roles": [payload.get("role")]}
 
+
+async def _verify_remote(token: str) -> dict:
     try:
-        async with httpx.AsyncClient(timeout=HTTPX_TIMEOUT) as client:
-            res = await client.get(
-                f"{AUTH_SERVICE_URL}/auth/me",
-                headers={"Authorization": f"Bearer {token}"},
-            )
+        res = await get_http_client().get(
+            f"{AUTH_SERVICE_URL}/auth/me",
+            headers={"Authorization": f"Bearer {token}"},
+        )
     except httpx.RequestError:
         raise HTTPException(status_code=503, detail="No se pudo conectar con auth-service")
 
@@ -48,7 +195,29 @@ async def verify_admin(authorization: Optional[str] = Header(default=None)):
             msg = "Token inválido"
         raise HTTPException(status_code=401, detail=msg)
 
-    user = res.json()  # esperado: {"id": "...", "username": "...", "roles": ["admin"]} o {"role": "admin"}
+    auth_stats["remote_verified"] += 1
+    return res.json()  # esperado: {"id": "...", "username": "...", "roles": ["admin"]} o {"role": "admin"}
+
+
+async def verify_admin(authorization: Optional[str] = Header(default=None)):
+    """
+    Exige Authorization: Bearer <JWT> y valida contra auth-service /auth/me
+    (o localmente con AUTH_LOCAL_VERIFY). Debe tener rol admin.
+    Las verificaciones exitosas se cachean hasta TOKEN_CACHE_TTL o el exp del token.
+    """
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Token inválido")
+
+    token = authorization.split(" ", 1)[1]
+
+    user = _cache_get(token)
+    if user is None:
+        if AUTH_LOCAL_VERIFY:
+            user = await _verify_locally(token)
+        if user is None:
+            user = await _verify_remote(token)
+        _cache_put(token, user)
+
     roles = user.get("roles") or []
     role = user.get("role")
     is_admin = ("admin" in roles) or (role == "admin")
@@ -78,8 +247,8 @@ async def verify_admin_or_open(authorization: Optional[str] = Header(default=Non
 
 async def check_low_stock(product: dict):
     """
-    Si el stock cae por debajo de min_stock, loguea y (opcionalmente)
-    notifica a Notifications Service. No debe romper el flujo.
+    Si el stock cae por debajo de min_stock, loguea y encola la alerta para
+    Notifications Service. No espera la notificación ni rompe el flujo.
     """
     try:
         stock = int(product.get("stock", 0))
@@ -88,23 +257,66 @@ async def check_low_stock(product: dict):
         if stock < min_stock:
             print(f"⚠️ Alerta: Producto {product.get('name')} bajo stock: {stock} (< {min_stock})")
 
-            # Construye payload correcto para /notifications/alerta-stock
+            # Payload de /notifications/alerta-stock (y de cada ítem de /alertas-stock)
             payload = {
                 "product_id": product.get("product_id"),
                 "current_stock": stock,
                 "min_stock": min_stock,
             }
-
-            # Llama al endpoint correcto
-            url = f"{NOTIFICATION_SERVICE_BASE}/alerta-stock"
-
-            async with httpx.AsyncClient(timeout=HTTPX_TIMEOUT) as client:
-                try:
-                    await client.post(url, json=payload)
-                except httpx.RequestError:
-                    # Silencioso: no bloquea el flujo del inventario
-                    pass
+            try:
+                _alert_queue.put_nowait(payload)
+                alert_stats["enqueued"] += 1
+            except asyncio.QueueFull:
+                alert_stats["dropped"] += 1
     except Exception:
         # Silencioso por seguridad
         pass
 
+
+async def _send_alerts(alerts: list):
+    client = get_http_client()
+    try:
+        res = await client.post(f"{NOTIFICATION_SERVICE_BASE}/alertas-stock", json={"alerts": alerts})
+        if res.status_code == 404:
+            # notifications-service sin endpoint por lotes: una llamada por alerta
+            for alert in alerts:
+                await client.post(f"{NOTIFICATION_SERVICE_BASE}/alerta-stock", json=alert)
+        elif res.status_code >= 400:
+            alert_stats["failed"] += len(alerts)
+            return
+        alert_stats["sent"] += len(alerts)
+        alert_stats["batches"] += 1
+    except httpx.RequestError:
+        # Silencioso: no bloquea el flujo del inventario
+        alert_stats["failed"] += len(alerts)
+
+
+async def run_alert_dispatcher():
+    """
+    Tarea de fondo: toma la primera alerta, junta las que lleguen durante
+    ALERT_COALESCE_WINDOW (la última por producto gana) y las envía en un lote.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        first = await _alert_queue.get()
+        pending = {first["product_id"]: first}
+        deadline = loop.time() + ALERT_COALESCE_WINDOW
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                alert = await asyncio.wait_for(_alert_queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if alert["product_id"] in pending:
+                alert_stats["coalesced"] += 1
+            pending[alert["product_id"]] = alert
+        try:
+            await _send_alerts(list(pending.values()))
+        except Exception:
+            alert_stats["failed"] += len(pending)
+
+
+def alert_dispatcher_stats() -> dict:
+    return {**alert_stats, "queued": _alert_queue.qsize(), "window": ALERT_COALESCE_WINDOW}
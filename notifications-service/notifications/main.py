@@ -1,5 +1,6 @@
 # notifications/main.py
 import os
+from typing import List
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 import redis.asyncio as redis
@@ -12,6 +13,9 @@ class StockAlert(BaseModel):
     current_stock: int
     min_stock: int
 
+class StockAlertBatch(BaseModel):
+    alerts: List[StockAlert]
+
 app = FastAPI()
 
 # Usa el host del servicio Redis en Docker, NO localhost (eso sería el contenedor).
@@ -39,3 +43,29 @@ async def alerta_stock(body: StockAlert):
         await send_mail(subject, ADMIN_EMAILS, html, text_fallback=f"Stock bajo {body.product_id}")
 
     return {"status": "alert_sent", "admins_notified": len(ADMIN_EMAILS)}
+
+@app.post("/notifications/alertas-stock")
+async def alertas_stock(body: StockAlertBatch):
+    """Varias alertas (ya agrupadas por inventory) en un solo push a redis y un solo correo."""
+    if not body.alerts:
+        return {"status": "no_alerts", "count": 0, "admins_notified": 0}
+
+    await r.lpush("alerts", *[f"{a.product_id}|{a.current_stock}|{a.min_stock}" for a in body.alerts])
+
+    if ADMIN_EMAILS:
+        subject = f"⚠️ Stock bajo: {len(body.alerts)} producto(s)"
+        rows = "".join(
+            f"<tr><td><b>{a.product_id}</b></td><td>{a.current_stock}</td><td>{a.min_stock}</td></tr>"
+            for a in body.alerts
+        )
+        html = f"""
+        <h2>Alerta de stock</h2>
+        <table>
+          <tr><th>Producto</th><th>Stock actual</th><th>Stock mínimo</th></tr>
+          {rows}
+        </table>
+        """
+        text = "\n".join(f"Stock bajo {a.product_id}: {a.current_stock} (< {a.min_stock})" for a in body.alerts)
+        await send_mail(subject, ADMIN_EMAILS, html, text_fallback=text)
+
+    return {"status": "alerts_sent", "count": len(body.alerts), "admins_notified": len(ADMIN_EMAILS)}
@@ -1,5 +1,8 @@
 import os
+import json
 import uuid
+import asyncio
+import logging
 import sqlite3
 from datetime import datetime
 from typing import Any, Dict, List, Optional
@@ -20,6 +23,13 @@ PRINT_PORT = int(os.getenv("PRINT_PORT", "4004"))
 FILES_DIR = os.getenv("FILES_DIR", "./files")
 DB_PATH = os.getenv("PRINT_LOG_DB", "logs.db")
 
+# Cola de impresión asíncrona
+PRINT_WORKERS = int(os.getenv("PRINT_WORKERS", "2"))
+PRINT_MAX_ATTEMPTS = int(os.getenv("PRINT_MAX_ATTEMPTS", "3"))
+PRINT_RETRY_BACKOFF = float(os.getenv("PRINT_RETRY_BACKOFF", "2"))  # s, se multiplica por el intento
+
+logger = logging.getLogger("uvicorn.error")
+
 os.makedirs(FILES_DIR, exist_ok=True)
 
 # -----------------------------
@@ -54,13 +64,23 @@ def init_db():
             created_at TEXT NOT NULL
         )
     """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS print_jobs (
+            job_id TEXT PRIMARY KEY,
+            invoice_id TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            pdf_url TEXT,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_print_jobs_status ON print_jobs(status)")
     conn.commit()
     conn.close()
 
-@app.on_event("startup")
-def _startup():
-    init_db()
-
 def log_print_job(job_id: str, invoice_id: str, status: str = "completed"):
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
@@ -71,6 +91,43 @@ def log_print_job(job_id: str, invoice_id: str, status: str = "completed"):
     conn.commit()
     conn.close()
 
+# -----------------------------
+# DB (SQLite) para trabajos de impresión
+# -----------------------------
+def create_print_job(job_id: str, invoice_id: str, invoice: Dict[str, Any]):
+    now = datetime.utcnow().isoformat()
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute(
+        "INSERT INTO print_jobs (job_id, invoice_id, payload, status, attempts, created_at, updated_at) "
+        "VALUES (?, ?, ?, 'queued', 0, ?, ?)",
+        (job_id, invoice_id, json.dumps(invoice), now, now)
+    )
+    conn.commit()
+    conn.close()
+
+def get_print_job(job_id: str) -> Optional[Dict[str, Any]]:
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    row = conn.execute("SELECT * FROM print_jobs WHERE job_id = ?", (job_id,)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+def update_print_job(job_id: str, **fields):
+    fields["updated_at"] = datetime.utcnow().isoformat()
+    cols = ", ".join(f"{k} = ?" for k in fields)
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute(f"UPDATE print_jobs SET {cols} WHERE job_id = ?", (*fields.values(), job_id))
+    conn.commit()
+    conn.close()
+
+def pending_print_jobs() -> List[str]:
+    conn = sqlite3.connect(DB_PATH)
+    rows = conn.execute(
+        "SELECT job_id FROM print_jobs WHERE status IN ('queued', 'processing') ORDER BY created_at"
+    ).fetchall()
+    conn.close()
+    return [r[0] for r in rows]
+
 # -----------------------------
 # Util: dibujar factura
 # -----------------------------
@@ -159,6 +216,80 @@ def generate_invoice_pdf(invoice: Dict[str, Any], invoice_id: str) -> str:
     c.save()
     return pdf_filename
 
+# -----------------------------
+# Workers de impresión
+# -----------------------------
+job_queue: Optional[asyncio.Queue] = None
+worker_tasks: List[asyncio.Task] = []
+retry_tasks: set = set()
+
+async def process_print_job(job_id: str):
+    # sqlite también bloquea: las consultas van en hilos como el render
+    job = await asyncio.to_thread(get_print_job, job_id)
+    if not job or job["status"] in ("completed", "failed"):
+        return
+
+    attempts = job["attempts"] + 1
+    await asyncio.to_thread(update_print_job, job_id, status="processing", attempts=attempts)
+
+    try:
+        invoice = json.loads(job["payload"])
+        # reportlab es bloqueante: se renderiza fuera del event loop
+        pdf_filename = await asyncio.to_thread(generate_invoice_pdf, invoice, job["invoice_id"])
+    except Exception as e:
+        if attempts >= PRINT_MAX_ATTEMPTS:
+            logger.warning("Trabajo %s falló definitivamente tras %s intentos: %s", job_id, attempts, e)
+            await asyncio.to_thread(update_print_job, job_id, status="failed", error=str(e))
+            try:
+                await asyncio.to_thread(log_print_job, job_id, job["invoice_id"], status="failed")
+            except Exception:
+                pass
+            return
+        logger.warning("Trabajo %s falló (intento %s/%s): %s", job_id, attempts, PRINT_MAX_ATTEMPTS, e)
+        await asyncio.to_thread(update_print_job, job_id, status="queued", error=str(e))
+        task = asyncio.create_task(requeue_later(job_id, PRINT_RETRY_BACKOFF * attempts))
+        retry_tasks.add(task)
+        task.add_done_callback(retry_tasks.discard)
+        return
+
+    await asyncio.to_thread(update_print_job, job_id, status="completed", pdf_url=f"/files/{pdf_filename}", error=None)
+    try:
+        await asyncio.to_thread(log_print_job, job_id, job["invoice_id"], status="completed")
+    except Exception:
+        pass
+
+async def requeue_later(job_id: str, delay: float):
+    await asyncio.sleep(delay)
+    await job_queue.put(job_id)
+
+async def print_worker():
+    while True:
+        job_id = await job_queue.get()
+        try:
+            await process_print_job(job_id)
+        except Exception as e:
+            logger.exception("Error procesando trabajo %s: %s", job_id, e)
+        finally:
+            job_queue.task_done()
+
+@app.on_event("startup")
+async def _startup():
+    global job_queue
+    init_db()
+    job_queue = asyncio.Queue()
+    # Reanuda lo que quedó pendiente si el servicio se reinició
+    for job_id in pending_print_jobs():
+        job_queue.put_nowait(job_id)
+    for _ in range(PRINT_WORKERS):
+        worker_tasks.append(asyncio.create_task(print_worker()))
+
+@app.on_event("shutdown")
+async def _shutdown():
+    for task in [*worker_tasks, *retry_tasks]:
+        task.cancel()
+    await asyncio.gather(*worker_tasks, *retry_tasks, return_exceptions=True)
+    worker_tasks.clear()
+
 # -----------------------------
 # Rutas
 # -----------------------------
@@ -182,7 +313,7 @@ def print_invoice(invoice_id: str, payload: Dict[str, Any] = Body(...)):
         raise HTTPException(status_code=500, detail=f"Error generando PDF: {e}")
 
     # Log
-    job_id = f"print-{uuid.uuid4().hex[:8]}"
+    job_id = f"print-{uuid.uuid4().hex}"
     try:
         log_print_job(job_id, invoice_id, status="completed")
     except Exception:
@@ -190,3 +321,33 @@ def print_invoice(invoice_id: str, payload: Dict[str, Any] = Body(...)):
 
     pdf_url = f"/files/{pdf_filename}"
     return JSONResponse({"pdf_url": pdf_url, "job_id": job_id})
+
+@app.post("/print/jobs/factura/{invoice_id}", status_code=202)
+async def enqueue_print_invoice(invoice_id: str, payload: Dict[str, Any] = Body(...)):
+    """
+    Espera: { "invoice": { ... } }
+    Encola la impresión y responde de inmediato con el job_id;
+    el PDF se consulta luego en GET /print/jobs/{job_id}.
+    """
+    invoice = payload.get("invoice")
+    if not invoice or not isinstance(invoice, dict):
+        raise HTTPException(status_code=400, detail="Cuerpo inválido: falta 'invoice'")
+
+    job_id = f"print-{uuid.uuid4().hex}"
+    await asyncio.to_thread(create_print_job, job_id, invoice_id, invoice)
+    await job_queue.put(job_id)
+    return {"job_id": job_id, "status": "queued"}
+
+@app.get("/print/jobs/{job_id}")
+def print_job_status(job_id: str):
+    job = get_print_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo de impresión no encontrado")
+    return {
+        "job_id": job["job_id"],
+        "invoice_id": job["invoice_id"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "pdf_url": job["pdf_url"],
+        "error": job["error"],
+    }